@@ -1,5 +1,6 @@
 """here live prompts that instruct (prime) GPT to generate Kroki code"""
 
+from functools import lru_cache
 from typing import List, Tuple
 
 import data_io
@@ -57,11 +58,16 @@ Respond "ACK" if you understand.
 
 basic_primers = [primer0, primer1, primer2, primer3]
 
-examples = data_io.load_problems_and_labels()
+@lru_cache(maxsize=None)
+def get_examples() -> Tuple[List[str], List[str]]:
+    """Load the examples on first use rather than at import time."""
+    return data_io.load_problems_and_labels()
 
-def get_advanced_primers(examples: Tuple[List[str], List[str]] = examples,
+def get_advanced_primers(examples: Tuple[List[str], List[str]] | None = None,
 number_of_examples: int = -1) -> List[str]:
     """Gather a list of examples in the format user: input-output, assistant: ACK."""
+    if examples is None:
+        examples = get_examples()
 
     advanced_primers = []
     advanced_primers.append("""
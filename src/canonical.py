@@ -0,0 +1,126 @@
+"""here lives canonicalization of generated diagram code, to recognize candidates that render the same diagram"""
+
+import json
+import re
+from typing import Dict, List, Tuple
+
+# prefixes of whole-line comments per diagram API, only stripped at the start of a line to spare e.g. "#FF0000" colors
+LINE_COMMENTS = {
+"dot": ["//", "#"],
+"graphviz": ["//", "#"],
+"blockdiag": ["//"],
+"seqdiag": ["//"],
+"actdiag": ["//"],
+"nwdiag": ["//"],
+"packetdiag": ["//"],
+"rackdiag": ["//"],
+"mermaid": ["%%"],
+"plantuml": ["'"],
+"c4plantuml": ["'"],
+"d2": ["#"],
+"nomnoml": ["//"],
+"pikchr": ["#", "//"],
+"dbml": ["//"],
+"erd": ["#"],
+"structurizr": ["#", "//"],
+}
+
+# prefixes of comments that may also end a line, only where they can't appear unquoted in diagram code
+INLINE_COMMENTS = {
+"dot": ["//"],
+"graphviz": ["//"],
+"blockdiag": ["//"],
+"seqdiag": ["//"],
+"actdiag": ["//"],
+"nwdiag": ["//"],
+"packetdiag": ["//"],
+"rackdiag": ["//"],
+"pikchr": ["//", "#"],
+"dbml": ["//"],
+}
+
+# block comments per diagram API
+BLOCK_COMMENTS = {
+"dot": re.compile(r"/\*.*?\*/", re.DOTALL),
+"graphviz": re.compile(r"/\*.*?\*/", re.DOTALL),
+"plantuml": re.compile(r"/'.*?'/", re.DOTALL),
+"c4plantuml": re.compile(r"/'.*?'/", re.DOTALL),
+"pikchr": re.compile(r"/\*.*?\*/", re.DOTALL),
+"structurizr": re.compile(r"/\*.*?\*/", re.DOTALL),
+}
+
+# APIs whose code is JSON, compared after parsing
+JSON_APIS = ["vega", "vegalite", "excalidraw"]
+
+# APIs where indentation carries meaning (ASCII art, nesting), only trailing whitespace is insignificant
+INDENTED_APIS = ["ditaa", "svgbob", "mermaid", "umlet", "diagramsnet", "bpmn", "wavedrom", "bytefield"]
+
+def strip_inline_comment(line: str, prefixes: Tuple[str, ...]) -> str:
+    """cut a line at the first comment prefix outside of a double-quoted string
+
+    args:
+        line: a line of diagram code
+        prefixes: the prefixes that start a comment, e.g. ("//",)
+    """
+    in_string = False
+    i = 0
+    while i < len(line):
+        if line[i] == "\\" and in_string:
+            i += 2 # skip the escaped character, e.g. \"
+            continue
+        if line[i] == '"':
+            in_string = not in_string
+        elif not in_string and line.startswith(prefixes, i):
+            return line[:i]
+        i += 1
+    return line
+
+def canonicalize(api: str, code: str) -> str:
+    """return a canonical form of diagram code, equal for code that renders the same diagram
+
+    The code is expected to be extracted already, i.e. without the text after "CODE_BLOCK_STOP".
+
+    args:
+        api: the diagram API, e.g. "mermaid"
+        code: the code of the diagram
+    """
+    code = code.split("CODE_BLOCK_STOP")[0]
+    if api in JSON_APIS:
+        try:
+            return json.dumps(json.loads(code), sort_keys=True, separators=(",", ":"))
+        except ValueError:
+            pass # invalid JSON is compared as text
+
+    if api in BLOCK_COMMENTS:
+        code = BLOCK_COMMENTS[api].sub("", code)
+    prefixes = tuple(LINE_COMMENTS.get(api, []))
+    inline_prefixes = tuple(INLINE_COMMENTS.get(api, []))
+    lines = []
+    for line in code.split("\n"):
+        if inline_prefixes:
+            line = strip_inline_comment(line, inline_prefixes)
+        line = line.rstrip()
+        if api not in INDENTED_APIS:
+            line = line.strip()
+        if not line.strip() or prefixes and line.lstrip().startswith(prefixes):
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+def group_candidates(candidates: List[Tuple[str, str]]) -> List[List[int]]:
+    """group candidates that render the same diagram
+
+    Candidates without an API or code, e.g. because extraction failed, are never grouped, since their raw
+    responses may differ.
+
+    args:
+        candidates: a (api, code) tuple per candidate
+
+    returns:
+        the indices of the candidates of each group, groups and indices in order
+    """
+    groups: Dict[Tuple[str, str] | int, List[int]] = {}
+    for i, (api, code) in enumerate(candidates):
+        key = (api, canonicalize(api, code)) if api and code else i
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
@@ -1,22 +1,41 @@
 """here lives code that directly interfaces with the openai API"""
 
-import copy
+from collections import OrderedDict
 from enum import Enum
+import hashlib
+import json
 from typing import List, Dict, Tuple
 import sys
 import multiprocessing as mp
+import queue
 import time
 
 import openai
-import tiktoken
 
 import secret
 import bot_primer
 from chatGPT import AbstractModel
 import const
+import metrics
+from latency import LatencyWindow
+from router import ApiRouter, route_bundle_messages
+from scheduler import Priority, RequestError, RequestScheduler, RetryableError
+from singleflight import SingleFlight
+import primer_bundle
+import tokens
 
 openai.api_key = secret.OPENAI_API_KEY
 
+# the openai request runs in a child started by a fork server rather than forked from this process: a forked child
+# would inherit the threads' state and the stdin of the local renderers' idle processes, which then don't see EOF
+# until the child exits, see subprocess_pool.py
+mp_context = mp.get_context("forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+if mp_context.get_start_method() == "forkserver":
+    mp_context.set_forkserver_preload(["chatGPT_official"])
+
+# identical requests in flight at the same time, e.g. from several users or batch entries, are sent only once
+completion_flights = SingleFlight()
+
 class InteractionMode(Enum):
     """handling of model state in a conversation
 
@@ -41,11 +60,16 @@ class Model(AbstractModel):
         presence_penalty: float = 0,
         frequency_penalty: float = 0,
         logit_bias: Dict[str, float] = {},
+        scheduler: RequestScheduler | None = None,
+        priority: Priority = Priority.INTERACTIVE,
+        hedge: bool = const.HEDGE_OPENAI,
+        max_history: int | None = const.MAX_HISTORY_MESSAGES if const.MEMORY_BOUNDED else None,
+        token_cache_size: int | None = const.TOKEN_CACHE_SIZE if const.MEMORY_BOUNDED else None,
         ):
 
         # openai api parameters
         self.model = model
-        self.messages = messages
+        self.messages = list(messages) # don't share the default list between models
         self.temperature = temperature
         self.n = n
         self.stream = stream
@@ -54,17 +78,77 @@ class Model(AbstractModel):
         self.frequency_penalty = frequency_penalty
         self.logit_bias = logit_bias
 
+        # scheduling, shared between models to respect the rate limits of one API key
+        self.scheduler = scheduler
+        self.priority = priority
+
+        # hedging, issue a duplicate request when the first one is slower than recent requests
+        self.hedge = hedge
+        self.latencies = LatencyWindow()
+
+        # token counts of message contents, seeded from the primer bundle, least recently used first
+        self.token_cache: OrderedDict[Tuple[Tuple[str, str], ...], int] = OrderedDict()
+        self.token_cache_size = token_cache_size
+        self.bundle: Dict | None = None
+
+        # routing, specialize the primer to the API family that a prompt likely needs
+        self.router: ApiRouter | None = None
+        self.route: str | None = None # the API family the message history is specialized to, None for the full primer
+        self.route_backup: str | None = None
+        self.primer_length = 0 # the number of messages of the full primer
+        self.max_history = max_history # the number of messages kept after the primer, None for unbounded
+
         # other
         self.messages_backup: List[Dict[str, str]] | None = None
         self.interaction_mode: InteractionMode = InteractionMode.IMPROVING
 
+    def __getstate__(self) -> Dict:
+        """the child process that performs a request doesn't need the (unpicklable) scheduler, nor the backup, bundle,
+        router, token counts and latencies"""
+        state = self.__dict__.copy()
+        state["scheduler"] = None
+        state["messages_backup"] = None
+        state["bundle"] = None
+        state["router"] = None
+        state["token_cache"] = OrderedDict()
+        state["latencies"] = LatencyWindow()
+        return state
+
     def backup_messages(self) -> None:
-        """backup the current message history"""
-        self.messages_backup = copy.deepcopy(self.messages)
+        """backup the current message history
+        
+        Messages are never modified once appended, so copying the list is enough.
+        """
+        self.messages_backup = list(self.messages)
+        self.route_backup = self.route
 
     def restore_backup_messages(self) -> None:
         """restore the message history from the backup"""
-        self.messages = copy.deepcopy(self.messages_backup)
+        self.messages = list(self.messages_backup)
+        self.route = self.route_backup
+
+    def history_start(self) -> int:
+        """return the index of the first message after the primer and examples"""
+        if self.route is not None:
+            return len(self.primer_messages(self.route))
+        return self.primer_length
+
+    def trim_history(self) -> None:
+        """forget the oldest turns after the primer until at most max_history messages remain, keeping the latest turn
+        
+        A turn is a user message and the assistant messages answering it.
+        """
+        if self.max_history is None:
+            return
+        start = self.history_start()
+        while len(self.messages) - start > self.max_history:
+            end = start + 1
+            while end < len(self.messages) and self.messages[end]["role"] != "user":
+                end += 1
+            if end == len(self.messages):
+                return
+            metrics.inc("natlagram_trimmed_messages_total", end - start, model=self.model)
+            del self.messages[start:end]
 
     def estimate_available_tokens(self, prompt: str, buffer: int = 10) -> int:
         """estimate the number of tokens available for a request
@@ -74,12 +158,75 @@ class Model(AbstractModel):
         """
         return self.max_tokens - self.estimate_tokens(prompt) - buffer
 
+    def admission_tokens(self, prompt: str, n: int) -> int:
+        """return the tokens that openai's rate limiter counts for a request: the prompt plus max_tokens per response
+        
+        args:
+            prompt: the prompt to the model by the user
+            n: the number of responses to generate
+        """
+        return self.estimate_tokens(prompt) + n * self.estimate_available_tokens(prompt)
+
     def reset_messages(self) -> None:
         """reset the message history to the primers and examples"""
         self.messages = []
+        self.route = None
+        if self.bundle is not None:
+            self.load_bundle(self.bundle)
+            return
         self.load_primers()
         self.load_examples()
 
+    def load_bundle(self, bundle: Dict) -> None:
+        """load the primers and examples of a compiled bundle into the message history
+
+        args:
+            bundle: a bundle, see primer_bundle.load_bundle
+        """
+        if bundle["model"] != self.model:
+            raise ValueError(f"The bundle was compiled for {bundle['model']}, not {self.model}.")
+        self.bundle = bundle
+        for message, num_tokens in zip(bundle["primers"], bundle["primer_tokens"]):
+            self.token_cache[self.message_key(message)] = num_tokens
+        for example in bundle["examples"]:
+            for message, num_tokens in zip(example["messages"], example["tokens"]):
+                self.token_cache[self.message_key(message)] = num_tokens
+        self.messages.extend(primer_bundle.bundle_messages(bundle))
+        self.primer_length = len(self.messages)
+
+    def primer_messages(self, route: str | None = None) -> List[Dict[str, str]] | None:
+        """return the primer messages of the loaded bundle
+        
+        args:
+            route: the API family the primer is specialized to, None for the full primer
+
+        returns:
+            the primer messages, None if no bundle is loaded
+        """
+        if self.bundle is None:
+            return None
+        if route is None:
+            return primer_bundle.bundle_messages(self.bundle)
+        return route_bundle_messages(self.bundle, route)
+
+    def route_messages(self, prompt: str) -> Tuple[List[Dict[str, str]], str] | None:
+        """return primer messages specialized to the API family that a prompt likely needs
+        
+        args:
+            prompt: the user's prompt to the model
+
+        returns:
+            a tuple with the specialized messages and the API family, None to keep the full primer when unsure
+        """
+        if self.router is None or self.bundle is None:
+            return None
+        family, confidence = self.router.predict(prompt)
+        if confidence < const.ROUTER_MIN_CONFIDENCE:
+            metrics.inc("natlagram_routed_prompts_total", family="none")
+            return None
+        metrics.inc("natlagram_routed_prompts_total", family=family)
+        return route_bundle_messages(self.bundle, family), family
+
     def append_failure_message(self) -> None:
         """append a message telling the model that it failed to generate correct code"""
         m1 = {"role": "user", "content": "The code fails to generate an image. Respond 'ACK' if you understand."}
@@ -97,6 +244,7 @@ class Model(AbstractModel):
         self.messages.append(d)
         
         if const.DEBUG == True:
+            self.primer_length = len(self.messages)
             return
 
         for i in range(1, len(primers)):
@@ -104,19 +252,23 @@ class Model(AbstractModel):
             self.messages.append(d)
             d = {"role": "assistant", "content": "ACK"}
             self.messages.append(d)
+        self.primer_length = len(self.messages)
 
-    def load_examples(self, examples: Tuple[List[str], List[str]] = bot_primer.examples) -> None:
+    def load_examples(self, examples: Tuple[List[str], List[str]] | None = None) -> None:
         """load examples into the message history
         
         args:
-            examples: a list of examples in the form (problem, solution) or (prompt, response) or (input, output)
+            examples: a list of examples in the form (problem, solution) or (prompt, response) or (input, output), defaults to bot_primer's examples
         """
+        if examples is None:
+            examples = bot_primer.get_examples()
         problems, solutions = examples
         for problem, solution in zip(problems, solutions):
             d = {"role": "user", "content": problem}
             self.messages.append(d)
             d = {"role": "assistant", "content": solution}
             self.messages.append(d)
+        self.primer_length = len(self.messages)
 
     def append_temp_message(self, message: Dict[str, str]) -> List[Dict[str, str]]:
         """return the list of messages with the new message appended
@@ -129,59 +281,187 @@ class Model(AbstractModel):
         """
         return self.messages + [message]
 
-    def complete_chat_to_queue(self, q: mp.Queue, prompt: str, temperature: float) -> None:
+    def complete_chat_to_queue(self, q: mp.Queue, max_tokens: int, temperature: float, n: int) -> None:
         """complete a chat with the openai api and put the response into a queue
         
         args:
-            q: a multiprocessing queue to put the model's response into
-            prompt: the prompt to the model by the user
+            q: a multiprocessing queue to put the model's response into, or the exception raised by the request
+            max_tokens: the maximum number of tokens per response, counted by the parent, see estimate_available_tokens
             temperature: temperature controls the determinism of the model's response
+            n: the number of responses to generate
         """
-        response = openai.ChatCompletion.create(
-            messages=self.messages,
-            max_tokens=self.estimate_available_tokens(prompt),
-            temperature=temperature,
-            model=self.model,
-            n=self.n,
-            stream=self.stream,
-            presence_penalty=self.presence_penalty,
-            frequency_penalty=self.frequency_penalty,
-            logit_bias=self.logit_bias,
-        )
+        try:
+            response = openai.ChatCompletion.create(
+                messages=self.messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                model=self.model,
+                n=n,
+                stream=self.stream,
+                presence_penalty=self.presence_penalty,
+                frequency_penalty=self.frequency_penalty,
+                logit_bias=self.logit_bias,
+            )
+        except openai.error.OpenAIError as e:
+            # openai errors lose their status and headers when pickled, so translate them here
+            status = e.http_status or 0
+            if status == 429 or status >= 500 or isinstance(e, (openai.error.Timeout, openai.error.APIConnectionError)):
+                retry_after = e.headers.get("retry-after") if e.headers else None
+                q.put(RetryableError(f"{type(e).__name__}: {e}", float(retry_after) if retry_after else None))
+            else:
+                q.put(RequestError(f"{type(e).__name__}: {e}"))
+            return
         q.put(response)
 
-    def complete_chat_verbose(self, prompt: str, temperature: float) -> Dict:
-        """complete a chat with the openai api and print the time elapsed
+    def start_completion(self, prompt: str, temperature: float, n: int) -> Tuple[mp.Process, mp.Queue, float]:
+        """start completing a chat with the openai api in a child process
         
         args:
             prompt: the user's prompt to the model
             temperature: temperature controls the determinism of the model's response
-        
+            n: the number of responses to generate
+
         returns:
-            the response from the openai api
+            a tuple with the child process, the queue it puts its response into and its start time
         """
-        q = mp.Queue()
-        p = mp.Process(target=self.complete_chat_to_queue, args=(q, prompt, temperature))
+        q = mp_context.Queue()
+        p = mp_context.Process(target=self.complete_chat_to_queue, args=(q, self.estimate_available_tokens(prompt), temperature, n))
         p.start()
+        return p, q, time.time()
+
+    def hedge_deadline(self) -> float | None:
+        """return the number of seconds after which a request is hedged, None if hedging is disabled or there is too little data"""
+        if not self.hedge or len(self.latencies) < const.HEDGE_MIN_SAMPLES:
+            return None
+        return self.latencies.percentile(const.HEDGE_PERCENTILE)
+
+    def complete_chat_process(self, prompt: str, temperature: float, n: int) -> Dict | None:
+        """complete a chat with the openai api in a child process and print the time elapsed
+
+        If hedging is enabled and no response arrives by the hedge deadline, a duplicate request is
+        started and the first response wins, the other request is cancelled.
+        
+        args:
+            prompt: the user's prompt to the model
+            temperature: temperature controls the determinism of the model's response
+            n: the number of responses to generate
+        
+        returns:
+            the response from the openai api, None if the request timed out
+        """
+        attempts = [self.start_completion(prompt, temperature, n)]
+        first_start = attempts[0][2]
+        deadline = self.hedge_deadline()
+        hedged = False
 
         start_time = time.time()
-        while p.is_alive():
+        response = None
+        while response is None:
             time_elapsed = time.time() - start_time
             sys.stdout.write(f"\rTime elapsed: {time_elapsed:.1f} seconds")
             time.sleep(0.1)
+
+            # poll the queues rather than the processes, a child can't exit before its response is consumed
+            for attempt in list(attempts):
+                p, q, _ = attempt
+                try:
+                    result = q.get_nowait()
+                except queue.Empty:
+                    if not p.is_alive() and q.empty():
+                        attempts.remove(attempt)
+                        result = RequestError("OpenAI request process exited without a response")
+                    else:
+                        continue
+                else:
+                    attempts.remove(attempt)
+                if isinstance(result, Exception):
+                    if attempts:
+                        continue # another attempt may still succeed
+                    sys.stdout.write("\n")
+                    raise result
+                response = result
+                # measure from the first attempt, so that a winning hedge doesn't hide the slow original from the percentile
+                self.latencies.record(time.time() - first_start)
+                break
+
+            if response is not None:
+                break
+            if not attempts:
+                sys.stdout.write("\n")
+                print("OpenAI request process exited without a response")
+                return
             if time_elapsed > const.TIMEOUT_OPENAI:
-                p.terminate()
+                for p, _, _ in attempts:
+                    p.terminate()
                 sys.stdout.write("\n")
                 print("OpenAI timed out")
                 return
+            if deadline is not None and not hedged and time_elapsed > deadline:
+                # a hedge costs tokens too, so only send it if the rate limits allow it right now
+                if self.scheduler is None or self.scheduler.try_acquire(self.admission_tokens(prompt, n)):
+                    sys.stdout.write("\n")
+                    print(f"No response after {deadline:.1f} seconds, hedging the request")
+                    attempts.append(self.start_completion(prompt, temperature, n))
+                    metrics.inc("natlagram_hedged_requests_total", model=self.model)
+                    hedged = True
         sys.stdout.write("\n")
 
-        # lead parent and child processes together
-        p.join(timeout=1)
-        # get the response from the child process
-        response = q.get()
+        # cancel the losing attempt, then lead parent and child processes together
+        for p, _, _ in attempts:
+            p.terminate()
+        for p, _, _ in attempts:
+            p.join(timeout=1)
         return response
 
+    def request_key(self, prompt: str, temperature: float, n: int) -> str:
+        """return a key that identifies a request by everything that is sent to the openai api
+        
+        args:
+            prompt: the user's prompt to the model
+            temperature: temperature controls the determinism of the model's response
+            n: the number of responses to generate
+        """
+        request = {
+            "messages": self.messages,
+            "temperature": temperature, # max_tokens is derived from the messages
+            "model": self.model,
+            "n": n,
+            "presence_penalty": self.presence_penalty,
+            "frequency_penalty": self.frequency_penalty,
+            "logit_bias": self.logit_bias,
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def complete_chat_verbose(self, prompt: str, temperature: float, n: int) -> Dict | None:
+        """complete a chat with the openai api, admitted by the scheduler if there is one
+
+        Concurrent identical requests are coalesced into a single call to the openai api.
+        
+        args:
+            prompt: the user's prompt to the model
+            temperature: temperature controls the determinism of the model's response
+            n: the number of responses to generate
+        
+        returns:
+            the response from the openai api, None if the request timed out
+        """
+        def complete() -> Dict | None:
+            num_tokens = self.estimate_tokens(prompt)
+            metrics.observe("natlagram_prompt_tokens", num_tokens, model=self.model)
+            with metrics.span("llm_call", model=self.model):
+                if self.scheduler is None:
+                    response = self.complete_chat_process(prompt, temperature, n)
+                else:
+                    response = self.scheduler.run(lambda: self.complete_chat_process(prompt, temperature, n),
+                        self.admission_tokens(prompt, n), self.priority)
+            if response is None:
+                metrics.inc("natlagram_llm_timeouts_total", model=self.model)
+            elif "usage" in response:
+                metrics.inc("natlagram_completion_tokens_total", response["usage"]["completion_tokens"], model=self.model)
+            return response
+
+        return completion_flights.do(self.request_key(prompt, temperature, n), complete)
+
     def generate_message_stateful(self, prompt: str, temperature: float | None = None, n: int | None = None, debug: bool = False) -> List[str]:
         """generate text responses from the model and remember the messages
         
@@ -191,7 +471,7 @@ class Model(AbstractModel):
             n: the number of responses to generate
 
         returns:
-            a list of text responses from the model
+            a list of text responses from the model, empty if the model didn't respond in time
         """
 
         if temperature is None:
@@ -199,13 +479,27 @@ class Model(AbstractModel):
         if n is None:
             n = self.n
 
+        # specialize the primer when a conversation starts
+        if self.route is None and len(self.messages) == self.primer_length:
+            routed = self.route_messages(prompt)
+            if routed is not None:
+                self.messages, self.route = routed
+
         message = {"role": "user", "content": prompt}
         self.messages.append(message)
 
-        response = self.complete_chat_verbose(prompt, temperature)
+        try:
+            response = self.complete_chat_verbose(prompt, temperature, n)
+        except Exception:
+            self.messages.remove(message) # forget the unanswered prompt
+            raise
+        if response is None:
+            self.messages.remove(message) # forget the unanswered prompt
+            return []
         assistant_messages = [choice["message"] for choice in response["choices"]]
         assistant_texts = [choice["message"]["content"] for choice in response["choices"]]
         self.messages = self.messages + assistant_messages
+        self.trim_history()
 
         if debug:
             print("prompt:", prompt)
@@ -237,7 +531,7 @@ class Model(AbstractModel):
             n: the number of responses to generate
 
         returns:
-            a list of text responses from the model
+            a list of text responses from the model, empty if the model didn't respond in time
         """
         if self.check_prompt_in_messages(prompt):
             prompt = "The code fails to generate an image. Correct the code."
@@ -278,7 +572,7 @@ class Model(AbstractModel):
             debug: print debug information
 
         returns:
-            a list of text responses from the model
+            a list of text responses from the model, empty if the model didn't respond in time
         """
         if temperature is None:
             temperature = self.temperature
@@ -286,12 +580,20 @@ class Model(AbstractModel):
             n = self.n
 
         message = {"role": "user", "content": prompt}
-        temp_messages = self.append_temp_message(message)
+        routed = self.route_messages(prompt)
+        if routed is not None:
+            temp_messages = routed[0] + [message]
+        else:
+            temp_messages = self.append_temp_message(message)
 
-        clean_messages = copy.deepcopy(self.messages)
+        clean_messages = self.messages # the temporary messages are a new list, the history is not modified
         self.messages = temp_messages
-        response = self.complete_chat_verbose(prompt, temperature)
-        self.messages = clean_messages
+        try:
+            response = self.complete_chat_verbose(prompt, temperature, n)
+        finally:
+            self.messages = clean_messages
+        if response is None:
+            return []
 
         texts = [choice["message"]["content"] for choice in response["choices"]]
 
@@ -311,7 +613,7 @@ class Model(AbstractModel):
             n: the number of responses to generate
 
         returns:
-            a list of text responses from the model
+            a list of text responses from the model, empty if the model didn't respond in time
         """
         if self.interaction_mode == InteractionMode.STATEFUL:
             return self.generate_message_stateful(prompt, temperature, n, debug)
@@ -322,6 +624,10 @@ class Model(AbstractModel):
         else:
             raise ValueError("Invalid model interaction mode")
 
+    def message_key(self, message: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+        """return a hashable key of a message for the token cache"""
+        return tuple(sorted(message.items()))
+
     def estimate_tokens(self, prompt: str | None = None) -> int:
         """Returns the number of tokens used by a list of messages.
         
@@ -336,23 +642,18 @@ class Model(AbstractModel):
         else:
             messages = self.messages + [{"role": "user", "content": prompt}]
 
-        try:
-            encoding = tiktoken.encoding_for_model(self.model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("cl100k_base")
-        if self.model in ["gpt-3.5-turbo"]:  # NOTE: future models may deviate from this
-            num_tokens = 0
-            for message in messages:
-                num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-                for key, value in message.items():
-                    num_tokens += len(encoding.encode(value))
-                    if key == "name":  # if there's a name, the role is omitted
-                        num_tokens += -1  # role is always required and always 1 token
-            num_tokens += 2  # every reply is primed with <im_start>assistant
-            return num_tokens
-        else:
-            raise NotImplementedError(f"""estimate_tokens() is not presently implemented for model {self.model}.
-        See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
+        num_tokens = 0
+        for message in messages:
+            # messages are counted once, the history is re-estimated many times per request
+            key = self.message_key(message)
+            if key in self.token_cache:
+                self.token_cache.move_to_end(key)
+            else:
+                self.token_cache[key] = tokens.count_message_tokens(message, self.model)
+                if self.token_cache_size is not None and len(self.token_cache) > self.token_cache_size:
+                    self.token_cache.popitem(last=False)
+            num_tokens += self.token_cache[key]
+        return num_tokens + tokens.REPLY_TOKENS
 
     def get_hi_temp(self) -> float:
         """Returns the highest temperature that the model can handle."""
@@ -366,5 +667,5 @@ if __name__ == "__main__":
     model.load_primers()
     model.load_examples()
     prompt = "When was Descartes born?."
-    tokens = model.estimate_tokens()
+    num_tokens = model.estimate_tokens()
     print(model.generate_message(prompt))
\ No newline at end of file
@@ -4,6 +4,53 @@ DEBUG=False # set to True to reduce the number of API calls during development
 FREE_API=True
 SERVER_URL = "localhost:8000"
 TIMEOUT_OPENAI = 40 # seconds
+OPENAI_RPM = 3500 # requests per minute admitted by the scheduler
+OPENAI_TPM = 90000 # tokens per minute admitted by the scheduler
+OPENAI_MAX_RETRIES = 5 # retries of requests that failed with 429 or 5xx
+HEDGE_OPENAI = False # issue a duplicate request when a response is slower than recent ones
+HEDGE_PERCENTILE = 95 # percentile of recent latencies after which a request is hedged
+HEDGE_MIN_SAMPLES = 20 # number of recorded latencies required before hedging
+USE_PRIMER_BUNDLE = True # load primers and examples from a compiled bundle with precomputed token counts
+COMPACT_PRIMERS = False # collapse the "Respond ACK" primer dialogue into a single system message
+ROUTE_PRIMERS = True # send only the instructions and examples of the API family a prompt likely needs
+ROUTER_MIN_CONFIDENCE = 0.6 # below this probability of the predicted API family, the full primer is sent
+ROUTER_MIN_WORDS = 2 # number of words of a prompt known to the router, below which the full primer is sent
+ADAPTIVE_SAMPLING = True # choose the number of candidates and the temperature from observed validity statistics
+SAMPLING_STATS_FILE = "temp/sampling_stats.json"
+SAMPLING_TEMPERATURES = [0.7, 1.0, 1.3]
+SAMPLING_TARGET = 0.9 # probability that at least one candidate of a request is valid
+SAMPLING_MAX_N = 5 # maximum number of candidates per request
+SAMPLING_MIN_ATTEMPTS = 20 # number of recorded candidates before the model's default candidate count and temperature are left
+SESSION_DIR = "temp/sessions" # where REPL sessions are saved
+PREVIEW_SCALE = 0.75 # size of the PNG preview shown before the full-quality artifacts are written, relative to the SVG's size at 96 DPI
+# local binaries that render SVG from stdin, used instead of kroki when installed
+LOCAL_RENDERERS = {
+"dot": ["dot", "-Tsvg"],
+"graphviz": ["dot", "-Tsvg"],
+"svgbob": ["svgbob"],
+}
+LOCAL_RENDERER_POOL_SIZE = 2 # idle processes kept warm per local binary
+TRACE_REQUESTS = False # capture every request into a rotating JSON lines log, see replay.py
+TRACE_FILE = "temp/traces/trace.jsonl"
+TRACE_MAX_BYTES = 10_000_000 # size at which the trace log is rotated
+TRACE_BACKUPS = 5 # number of rotated trace logs to keep
+# worker threads per pipeline stage, the llm stage has one worker per model
+PIPELINE_WORKERS = {
+"extract": 1,
+"render": 4,
+"validate": 1,
+"convert": 2,
+"store": 1,
+}
+PIPELINE_QUEUE_SIZE = 16 # items waiting per pipeline stage before the stage feeding it blocks
+BATCH_MODELS = 4 # concurrent openai requests in batch mode
+MEMORY_BOUNDED = False # opt-in, cap conversation history, caches and open figures so that long-running processes don't creep
+MAX_HISTORY_MESSAGES = 40 # messages kept after the primer in memory-bounded mode, the oldest turns are forgotten
+TOKEN_CACHE_SIZE = 4096 # token counts of messages kept in memory-bounded mode, least recently used are evicted
+MAX_OPEN_FIGURES = 3 # preview windows kept open in memory-bounded mode, older ones are closed
+TRACE_ALLOCATIONS = False # record the peak Python heap of every request with tracemalloc, which slows down allocations
+WARM_UP_KROKI = True # render a tiny diagram per service in the background at startup
+TIMEOUT_WARM_UP = 60 # seconds, per render during warm-up
 SERVICES = [
 "actdiag",
 "bpmn",
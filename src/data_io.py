@@ -1,6 +1,13 @@
 """functions for saving and loading data."""
 
+from contextlib import contextmanager
+import hashlib
+import json
+import os
 from pathlib import Path
+import threading
+import time
+from typing import Dict, Iterator, List
 
 RESOURCES = Path("resources/select_problems_and_labels.txt")
 
@@ -11,7 +18,7 @@ def load_problems_and_labels(problem_file: Path = RESOURCES):
         
         problems = []
         labels = []
-        current_block = ""
+        current_block = [] # lines of the current block, joined once the block is complete
 
         for line in lines:
             # ignore lines starting with # or "\n"
@@ -19,38 +26,127 @@ def load_problems_and_labels(problem_file: Path = RESOURCES):
                 continue
             # if line starts with "---PROBLEM", then it's a new problem
             if line.startswith("---PROBLEM"):
-                labels.append("CODE_BLOCK_START\n" + current_block)
-                current_block = ""
+                labels.append("CODE_BLOCK_START\n" + "".join(current_block))
+                current_block = []
                 continue
             # if line starts with "CODE_BLOCK_START", then it's a new label
             if line.startswith("CODE_BLOCK_START"):
-                problems.append(current_block)
-                current_block = ""
+                problems.append("".join(current_block))
+                current_block = []
                 continue
-            current_block += line + "\n"
+            current_block.append(line + "\n")
 
         # add the last label
-        labels.append(current_block)
+        labels.append("CODE_BLOCK_START\n" + "".join(current_block))
         
         # discard first, empty label
         labels = labels[1:]
     
     return problems, labels
 
-def number_file_name(path: Path) -> Path:
-    """Return a path with a file name that does not exist by appending a number to the end of the file name.
-    
+@contextmanager
+def atomic_path(path: Path) -> Iterator[Path]:
+    """yield a temporary path to write to, which is renamed to the given path if writing succeeds
+
+    Readers never see a partial file, and concurrent writers, e.g. threads or processes, never share a temporary file.
+
+    args:
+        path: the final path of the file, its directory is created if needed
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f".{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp{path.suffix}")
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+class OutputStore:
+    """store generated artifacts under content-addressed names in sharded directories
+
+    Artifacts of a diagram are named after a hash of its API and code, so naming needs no probing
+    of the file system and concurrent writers never pick the same name for different diagrams.
+    Files are written to a temporary name first and renamed into place, so readers never see partial files.
+    An index file maps prompts to artifacts.
+
     args:
-        path: the path to the file
+        root: the directory to store artifacts in
+        shard_length: the number of hash characters used to name the shard directory
     """
-    if not path.exists():
-        return path
-    else:
-        for i in range(100):
-            temp_path = path.parent / f"{path.stem}_{i}{path.suffix}"
-            if not temp_path.exists():
-                return temp_path
-    raise ValueError(f"Could not find a file name for {path}.")
+
+    def __init__(self, root: Path, shard_length: int = 2) -> None:
+        self.root = root
+        self.shard_length = shard_length
+        self.index_path = root / "index.jsonl"
+        self.lock = threading.Lock()
+
+    def key(self, api: str, code: str) -> str:
+        """return the content hash that names the artifacts of a diagram
+        
+        args:
+            api: the diagram API, e.g. "mermaid"
+            code: the code of the diagram
+        """
+        return hashlib.sha256(f"{api}\n{code}".encode("utf-8")).hexdigest()[:16]
+
+    def path(self, key: str, file_name: str, suffix: str) -> Path:
+        """return the path of an artifact
+        
+        args:
+            key: the content hash of the diagram
+            file_name: a human-readable prefix of the file name, e.g. the diagram API
+            suffix: the suffix of the artifact, e.g. ".svg"
+        """
+        return self.root / key[:self.shard_length] / f"{file_name}_{key}{suffix}"
+
+    def write_bytes(self, path: Path, data: bytes) -> None:
+        """atomically write bytes to an artifact
+        
+        args:
+            path: the path of the artifact
+            data: the content of the artifact
+        """
+        with atomic_path(path) as temp_path:
+            temp_path.write_bytes(data)
+
+    def add_to_index(self, prompt: str, api: str, key: str, artifacts: Dict[str, Path]) -> None:
+        """record which artifacts were generated for a prompt
+        
+        args:
+            prompt: the user prompt
+            api: the diagram API
+            key: the content hash of the diagram
+            artifacts: maps formats, e.g. "svg", to the paths of the artifacts
+        """
+        record = {
+            "time": time.time(),
+            "prompt": prompt,
+            "api": api,
+            "key": key,
+            "artifacts": {fmt: str(path.relative_to(self.root)) for fmt, path in artifacts.items()},
+        }
+        line = json.dumps(record) + "\n"
+        self.root.mkdir(parents=True, exist_ok=True)
+        # a single append of one line is atomic across processes, the lock serializes threads
+        with self.lock, open(self.index_path, "a") as f:
+            f.write(line)
+
+    def lookup(self, prompt: str) -> List[Dict]:
+        """return the index records of a prompt, oldest first
+        
+        args:
+            prompt: the user prompt
+        """
+        if not self.index_path.exists():
+            return []
+        records = []
+        with open(self.index_path, "r") as f:
+            for line in f:
+                record = json.loads(line)
+                if record["prompt"] == prompt:
+                    records.append(record)
+        return records
 
 if __name__ == "__main__":
     problems, labels = load_problems_and_labels()
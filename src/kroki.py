@@ -1,9 +1,17 @@
 """here lives code that interfaces with the kroki server's API"""
 
+from abc import ABC, abstractmethod
 import base64
+import shutil
+import subprocess
+import threading
+import time
 import zlib
-import requests
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import BinaryIO, Dict, List, Tuple
+
+import requests
 
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
@@ -12,10 +20,50 @@ import pdfkit # NOTE: this dependency is not maintained
 import weasyprint
 
 import const
-import data_io
+import metrics
+from singleflight import SingleFlight
+from subprocess_pool import SubprocessPool
 
 plt.rcParams['savefig.dpi'] = 300
 
+# identical renders in flight at the same time, e.g. identical candidates or prompts, are fetched only once
+render_flights = SingleFlight()
+
+# tiny, known-good diagrams used to warm up each service (and its companion container) at startup
+WARM_UP_DIAGRAMS = {
+"actdiag": "actdiag {\n  a -> b\n}",
+"bpmn": """<?xml version="1.0" encoding="UTF-8"?>
+<bpmn:definitions xmlns:bpmn="http://www.omg.org/spec/BPMN/20100524/MODEL" xmlns:bpmndi="http://www.omg.org/spec/BPMN/20100524/DI" xmlns:dc="http://www.omg.org/spec/DD/20100524/DC" id="d" targetNamespace="http://bpmn.io/schema/bpmn">
+<bpmn:process id="p"><bpmn:startEvent id="s" /></bpmn:process>
+<bpmndi:BPMNDiagram id="g"><bpmndi:BPMNPlane id="l" bpmnElement="p"><bpmndi:BPMNShape id="s_di" bpmnElement="s"><dc:Bounds x="0" y="0" width="36" height="36" /></bpmndi:BPMNShape></bpmndi:BPMNPlane></bpmndi:BPMNDiagram>
+</bpmn:definitions>""",
+"pikchr": 'box "A"',
+"nwdiag": "nwdiag {\n  network n {\n    a;\n  }\n}",
+"c4plantuml": '@startuml\n!include C4_Context.puml\nPerson(a, "A")\n@enduml',
+"rackdiag": "rackdiag {\n  1: A\n}",
+"dot": "digraph {\n  a -> b\n}",
+"d2": "a -> b",
+"mermaid": "graph LR\n  A-->B",
+"erd": "[A]\n*id",
+"graphviz": "digraph {\n  a -> b\n}",
+"vegalite": '{"data": {"values": [{"a": 1}]}, "mark": "point", "encoding": {"x": {"field": "a", "type": "quantitative"}}}',
+"ditaa": "+---+\n| A |\n+---+",
+"umlet": '<diagram program="umlet" version="14.3.0"><element><id>UMLClass</id><coordinates><x>0</x><y>0</y><w>100</w><h>30</h></coordinates><panel_attributes>A</panel_attributes><additional_attributes></additional_attributes></element></diagram>',
+"diagramsnet": '<mxGraphModel><root><mxCell id="0" /><mxCell id="1" parent="0" /><mxCell id="2" value="A" vertex="1" parent="1"><mxGeometry x="0" y="0" width="80" height="40" as="geometry" /></mxCell></root></mxGraphModel>',
+"plantuml": "@startuml\nA -> B\n@enduml",
+"seqdiag": "seqdiag {\n  a -> b\n}",
+"nomnoml": "[A] -> [B]",
+"wavedrom": '{ signal: [{ name: "a", wave: "01" }] }',
+"structurizr": 'workspace {\n  model {\n    u = person "User"\n  }\n  views {\n    systemLandscape {\n      include *\n    }\n  }\n}',
+"bytefield": "(draw-column-headers)",
+"excalidraw": '{"type": "excalidraw", "version": 2, "elements": [], "appState": {}}',
+"dbml": "Table a {\n  id int\n}",
+"packetdiag": "packetdiag {\n  0-7: A\n}",
+"svgbob": "a --> b",
+"vega": '{"width": 10, "height": 10, "marks": []}',
+"blockdiag": "blockdiag {\n  A -> B\n}",
+}
+
 def check_kroki_server(server_url: str = const.SERVER_URL) -> None:
     """Check if the kroki server is running
     
@@ -47,6 +95,20 @@ def generate_url_from_str(diagram: str, diagram_api: str, output_format: str, se
     url = f"http://{server_url}/{diagram_api}/{output_format}/{url_diagram}"
     return url
 
+def fetch(url: str) -> requests.Response:
+    """Fetch a diagram from the kroki server, coalescing concurrent requests for the same diagram
+
+    The URL encodes the diagram API, the output format and the compressed code, so it identifies a render.
+
+    args:
+        url: the URL to the diagram
+
+    returns:
+        the response of the kroki server
+    """
+    with metrics.span("kroki_fetch"):
+        return render_flights.do(url, lambda: requests.get(url))
+
 def generate_url_from_file(path: str, diagram_api: str, output_format: str, server_url: str) -> str:
     """Generate a URL from a file
     
@@ -72,14 +134,15 @@ def save_image_from_url(url: str, output_path: str) -> None:
         url: the URL to the diagram
         output_path: the path to the output image
     """
-    r = requests.get(url)
+    r = fetch(url)
     if r.status_code != 200:
         reason = "Kroki returned non-200 status code\n"
         reason += r.text
         raise requests.RequestException(reason)
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(output_path, "wb") as f:
-        f.write(r.content)
+    with metrics.span("write_svg"):
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, "wb") as f:
+            f.write(r.content)
 
 def convert_text_to_image(diagram: str, diagram_api: str, output_format: str, server_url: str) -> bytes:
     """Generate an image from a string
@@ -94,7 +157,7 @@ def convert_text_to_image(diagram: str, diagram_api: str, output_format: str, se
         the image as a byte array
     """
     url = generate_url_from_str(diagram, diagram_api, output_format, server_url)
-    r = requests.get(url)
+    r = fetch(url)
     return r.content
 
 def check_image_valid(url: str, service: str, code: str) -> bool:
@@ -108,29 +171,42 @@ def check_image_valid(url: str, service: str, code: str) -> bool:
     return:
         True if the image was generated successfully, False otherwise
     """
-    def check_copy_services(response, code: str):
+    r = fetch(url)
+    if r.status_code == 200:
+        return check_content_valid(r.text, service, code)
+    else:
+        return False
+
+def check_content_valid(text: str, service: str, code: str) -> bool:
+    """Check if a rendered image is valid, some services render an error message instead of failing
+    
+    args:
+        text: the rendered image as text, e.g. SVG
+        service: the service used to generate the image (Diagram API), e.g. "dot" means Graphviz
+        code: the code describing the diagram, e.g. "graph LR; A-->B;"
+
+    return:
+        True if the image is valid, False otherwise
+    """
+    def check_copy_services(text: str, code: str):
         """The D2 generated image shouldn't yield a copy of the code"""
-        return False if code in response.text else True
-    def check_ditaa(response):
+        return False if code in text else True
+    def check_ditaa(text: str):
         """Ditaa returns an 'This XML file does not appear to have any style information associated with it. The document tree is shown below.' if the code is invalid but response code is still 200"""
-        return False if "This XML file does not appear to have any style information" in response.text else True
-    def check_service_mermaid(response):
+        return False if "This XML file does not appear to have any style information" in text else True
+    def check_service_mermaid(text: str):
         """Mermaid returns an 'Syntax Error' if the code is invalid but response code is still 200"""
-        return False if "Syntax error in graph" in response.text else True
+        return False if "Syntax error in graph" in text else True
 
-    r = requests.get(url)
-    if r.status_code == 200:
-        if service in ["d2", "ditaa", "nomnoml"]:
-            return check_copy_services(r, code)
-        if service == "ditaa":
-            return check_ditaa(r)
-        elif service == "mermaid":
-            return check_service_mermaid(r)
-        return True
-    else:
-        return False
+    if service in ["d2", "ditaa", "nomnoml"]:
+        return check_copy_services(text, code)
+    if service == "ditaa":
+        return check_ditaa(text)
+    elif service == "mermaid":
+        return check_service_mermaid(text)
+    return True
 
-def convert_svg_to_png(svg: Path) -> Path:
+def convert_svg_to_png(svg: Path, png: Path | None = None, dpi: int = 300) -> Path:
     """Convert an SVG image to a PNG image
     NOTE:
         Doesn't work properly on Ubuntu hosts when Ubuntu can't display the SVG text
@@ -138,12 +214,46 @@ def convert_svg_to_png(svg: Path) -> Path:
 
     args:
         svg: the path to the SVG image
+        png: the path to the PNG image, defaults to the SVG's path with a .png suffix
+        dpi: the resolution of the PNG image
 
     returns:
         the path to the PNG image
     """
-    cairosvg.svg2png(url=str(svg), write_to=str(svg.with_suffix(".png")), dpi=300)
-    return svg.with_suffix(".png")
+    if png is None:
+        png = svg.with_suffix(".png")
+    with metrics.span("convert_png"):
+        cairosvg.svg2png(url=str(svg), write_to=str(png), dpi=dpi)
+    return png
+
+def convert_svg_content_to_png(svg_content: bytes, dpi: int = 300) -> bytes:
+    """Convert an SVG image to a PNG image in memory
+
+    args:
+        svg_content: the SVG image
+        dpi: the resolution of the PNG image
+
+    returns:
+        the PNG image
+    """
+    with metrics.span("convert_png"):
+        return cairosvg.svg2png(bytestring=svg_content, dpi=dpi)
+
+def convert_svg_content_to_preview(svg_content: bytes, scale: float = const.PREVIEW_SCALE) -> bytes:
+    """Convert an SVG image to a low-resolution PNG preview in memory
+
+    The resolution only applies to physical units (pt, mm, in), while most diagram APIs size their SVGs in px.
+    The preview is therefore scaled, relative to the CSS resolution of 96 DPI, so that it is smaller for both.
+
+    args:
+        svg_content: the SVG image
+        scale: the size of the preview relative to the SVG's size
+
+    returns:
+        the PNG image
+    """
+    with metrics.span("convert_png"):
+        return cairosvg.svg2png(bytestring=svg_content, dpi=96, scale=scale)
 
 def print_image_from_url(url: str, output_path: str) -> None:
     """Generate an image from a URL and print it
@@ -152,14 +262,27 @@ def print_image_from_url(url: str, output_path: str) -> None:
         url: the URL to the diagram
         output_path: the path to the output image
     """
-    r = requests.get(url)
+    r = fetch(url)
     if r.status_code == 200:
-        pdfkit.from_url(url, output_path)
+        with metrics.span("convert_pdf"):
+            pdfkit.from_url(url, output_path)
     else:
         reason = "Kroki returned non-200 status code\n"
         reason += r.text
         raise requests.RequestException(reason)
 
+def print_svg_content(svg_content: bytes) -> bytes:
+    """Print an SVG image to PDF in memory, with cairosvg since wkhtmltopdf would read the SVG as HTML from stdin
+
+    args:
+        svg_content: the SVG image
+
+    returns:
+        the PDF document
+    """
+    with metrics.span("convert_pdf"):
+        return cairosvg.svg2pdf(bytestring=svg_content)
+
 def print_image_from_url_weasyprint(url: str, output_path: str) -> None:
     """Generate an image from a URL and print it
     
@@ -167,24 +290,54 @@ def print_image_from_url_weasyprint(url: str, output_path: str) -> None:
         url: the URL to the diagram
         output_path: the path to the output image
     """
-    r = requests.get(url)
+    r = fetch(url)
     if r.status_code == 200:
-        weasyprint.HTML(url).write_pdf(output_path)
+        with metrics.span("convert_pdf"):
+            weasyprint.HTML(url).write_pdf(output_path)
     else:
         reason = "Kroki returned non-200 status code\n"
         reason += r.text
         raise requests.RequestException(reason)
 
-def show_image(path: Path) -> None:
+def show_image(path: Path, block: bool = True) -> None:
     """Show an image
     
     args:
         path: the path to the image
+        block: whether to wait until the window is closed
     """
     with open(path, "rb") as f:
-        img = mpimg.imread(f)
-        plt.imshow(img)
-        plt.show()
+        show_png(f, block)
+
+def show_png(f: BinaryIO, block: bool = True) -> None:
+    """Show a PNG image
+
+    args:
+        f: a file-like object with the PNG image, e.g. io.BytesIO
+        block: whether to wait until the window is closed
+    """
+    img = mpimg.imread(f, format="png")
+    figure = plt.figure()
+    plt.imshow(img)
+    plt.axis("off")
+    plt.show(block=block)
+    if block:
+        plt.close(figure) # the window was closed, free the figure
+        return
+    close_old_figures()
+    plt.pause(0.001) # let the GUI event loop draw the figure
+
+def close_old_figures(keep: int | None = const.MAX_OPEN_FIGURES if const.MEMORY_BOUNDED else None) -> None:
+    """close all but the most recent figures, pyplot keeps figures alive until they are closed
+
+    args:
+        keep: the number of figures to keep open, None to keep all
+    """
+    if keep is None:
+        return
+    numbers = plt.get_fignums()
+    for number in numbers[:max(0, len(numbers) - keep)]:
+        plt.close(number)
 
 def test_failure_detection() -> bool:
     """Test that the failure detection works for each service
@@ -206,24 +359,192 @@ def test_failure_detection() -> bool:
             return False
     return True
 
-def save_images(img_url: str, work_dir: Path, file_name: str = "natlagram", show: bool = True) -> None:
-    """save an image at a given url in multiple formats
-    
+class RenderError(Exception):
+    """the diagram code is invalid, no other renderer would succeed either"""
+
+class RendererUnavailable(Exception):
+    """the renderer couldn't render the diagram for reasons unrelated to its code, another renderer may succeed"""
+
+class Renderer(ABC):
+    """renders diagram code to an image"""
+
+    name = "renderer"
+
+    @abstractmethod
+    def supports(self, diagram_api: str, output_format: str) -> bool:
+        """return whether the renderer can render diagrams of an API in a format"""
+
+    @abstractmethod
+    def render(self, diagram: str, diagram_api: str, output_format: str) -> bytes:
+        """render a diagram
+
+        args:
+            diagram: the diagram as a string
+            diagram_api: the api chosen for the the diagram, e.g. "dot" means Graphviz
+            output_format: the format of generated image, e.g. SVG, PNG, ...
+
+        returns:
+            the image as a byte array, raises RenderError if the diagram is invalid and RendererUnavailable otherwise
+        """
+
+class KrokiRenderer(Renderer):
+    """renders diagrams with the kroki server's HTTP API, supports every service"""
+
+    name = "kroki"
+
+    def __init__(self, server_url: str = const.SERVER_URL) -> None:
+        self.server_url = server_url
+
+    def supports(self, diagram_api: str, output_format: str) -> bool:
+        return True
+
+    def render(self, diagram: str, diagram_api: str, output_format: str) -> bytes:
+        url = generate_url_from_str(diagram, diagram_api, output_format, self.server_url)
+        try:
+            r = fetch(url)
+        except requests.exceptions.ConnectionError as e:
+            raise RendererUnavailable(f"Kroki server is not reachable: {e}") from e
+        if r.status_code in [502, 503, 504]: # e.g. a companion container is down
+            raise RendererUnavailable(f"Kroki returned status code {r.status_code}")
+        if r.status_code != 200:
+            raise RenderError(r.text)
+        return r.content
+
+class LocalRenderer(Renderer):
+    """renders diagrams with local binaries, e.g. graphviz' dot, kept warm in subprocess pools
+
     args:
-        img_url: the url of the image
-        work_dir: the directory to save the image in
-        file_name: name given to image
-        show: whether to show the image or not
+        commands: maps diagram APIs to the command rendering SVG from stdin, APIs whose binary isn't installed are skipped
+        pool_size: the number of idle processes per command
+        timeout: the number of seconds after which a render is killed
     """
-    svg = work_dir / f"{file_name}.svg"
-    pdf = work_dir / f"{file_name}.pdf"
-    svg = data_io.number_file_name(svg)
-    pdf = data_io.number_file_name(pdf)
-    save_image_from_url(img_url, svg)
-    print_image_from_url(img_url, pdf)
-    png = convert_svg_to_png(svg)
-    if show:
-        show_image(png)
+
+    name = "local"
+
+    def __init__(self, commands: Dict[str, List[str]] = const.LOCAL_RENDERERS, pool_size: int = const.LOCAL_RENDERER_POOL_SIZE, timeout: float = 30) -> None:
+        self.commands = {api: command for api, command in commands.items() if shutil.which(command[0]) is not None}
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.pools: Dict[Tuple[str, ...], SubprocessPool] = {}
+        self.lock = threading.Lock() # render workers and the warm-up thread create pools concurrently
+
+    def pool(self, diagram_api: str) -> SubprocessPool:
+        """return the pool of a diagram API, APIs with the same command share a pool"""
+        command = tuple(self.commands[diagram_api])
+        with self.lock:
+            if command not in self.pools:
+                self.pools[command] = SubprocessPool(list(command), self.pool_size)
+            return self.pools[command]
+
+    def warm_up(self) -> None:
+        """start the idle processes of every available command"""
+        for diagram_api in self.commands:
+            self.pool(diagram_api).warm_up()
+
+    def close(self) -> None:
+        """terminate all idle processes"""
+        with self.lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            pool.close()
+
+    def supports(self, diagram_api: str, output_format: str) -> bool:
+        return output_format == "svg" and diagram_api in self.commands
+
+    def render(self, diagram: str, diagram_api: str, output_format: str) -> bytes:
+        try:
+            returncode, stdout, stderr = self.pool(diagram_api).run(diagram.encode("utf-8"), self.timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise RendererUnavailable(f"{self.commands[diagram_api][0]} failed: {e}") from e
+        if returncode != 0:
+            raise RenderError(stderr.decode("utf-8", errors="replace"))
+        return stdout
+
+# local binaries are tried first for the APIs they support, kroki is the fallback for everything
+local_renderer = LocalRenderer()
+renderers: List[Renderer] = [local_renderer, KrokiRenderer()]
+
+def render_diagram(diagram: str, diagram_api: str, output_format: str = "svg") -> bytes:
+    """render a diagram with the first renderer that supports it, falling back to the next if a renderer is unavailable
+
+    args:
+        diagram: the diagram as a string
+        diagram_api: the api chosen for the the diagram, e.g. "dot" means Graphviz
+        output_format: the format of generated image, e.g. SVG, PNG, ...
+
+    returns:
+        the image as a byte array, raises RenderError if the diagram is invalid
+    """
+    error = None
+    for renderer in renderers:
+        if not renderer.supports(diagram_api, output_format):
+            continue
+        key = (renderer.name, diagram_api, output_format, diagram)
+        try:
+            with metrics.span("render_backend", backend=renderer.name):
+                return render_flights.do(key, lambda: renderer.render(diagram, diagram_api, output_format))
+        except RendererUnavailable as e:
+            metrics.inc("natlagram_renderer_fallbacks_total", backend=renderer.name)
+            error = e
+    raise RendererUnavailable(f"No renderer could render {diagram_api} as {output_format}: {error}")
+
+def warm_up_service(service: str, server_url: str = const.SERVER_URL) -> Tuple[float, float]:
+    """Render a tiny diagram twice to warm up a service and measure its cold and warm latency
+
+    args:
+        service: the service (Diagram API) to warm up, e.g. "mermaid"
+        server_url: the URL of the kroki server
+
+    returns:
+        a tuple with the cold and the warm latency in seconds
+    """
+    url = generate_url_from_str(WARM_UP_DIAGRAMS[service], service, "svg", server_url)
+    latencies = []
+    for _ in range(2): # the first render is cold, the second one is warm
+        start_time = time.time()
+        r = requests.get(url, timeout=const.TIMEOUT_WARM_UP)
+        if r.status_code != 200:
+            reason = f"Kroki returned non-200 status code while warming up {service}\n"
+            reason += r.text
+            raise requests.RequestException(reason)
+        latencies.append(time.time() - start_time)
+    return latencies[0], latencies[1]
+
+def warm_up_services(services: List[str] = const.SERVICES, server_url: str = const.SERVER_URL,
+    ready: Dict[str, threading.Event] | None = None) -> Dict[str, Tuple[float, float]]:
+    """Concurrently warm up the given services so that the first real request doesn't pay the cold-start cost
+
+    Services that fail to warm up are reported but don't raise, since a missing companion container
+    should not prevent the REPL from starting.
+
+    args:
+        services: the services (Diagram APIs) to warm up
+        server_url: the URL of the kroki server
+        ready: events per service, each is set as soon as its service is warmed up or failed to
+
+    returns:
+        a dictionary mapping each successfully warmed up service to its (cold, warm) latency in seconds
+    """
+    latencies = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(services))) as executor:
+        futures = {executor.submit(warm_up_service, service, server_url): service for service in services}
+        for future in as_completed(futures):
+            service = futures[future]
+            try:
+                latencies[service] = future.result()
+                metrics.observe("natlagram_warm_up_seconds", latencies[service][0], api=service, phase="cold")
+                metrics.observe("natlagram_warm_up_seconds", latencies[service][1], api=service, phase="warm")
+            except requests.RequestException as e:
+                print(f"Could not warm up {service}: {e}")
+            if ready is not None and service in ready:
+                ready[service].set()
+    return latencies
+
+def report_artifact_failure(future: Future) -> None:
+    """print the error of a candidate's store stage, e.g. as a done callback of Candidate.stored"""
+    error = future.exception()
+    if error is not None:
+        print(f"\nCould not save full-quality images: {error}")
 
 if __name__ == "__main__":
     test_diagram = """
@@ -0,0 +1,30 @@
+"""here lives a window of recent latencies used to derive deadlines, e.g. for hedged requests"""
+
+from collections import deque
+from typing import Deque
+
+class LatencyWindow:
+    """keep the most recent latencies and compute percentiles over them"""
+
+    def __init__(self, size: int = 100) -> None:
+        self.latencies: Deque[float] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self.latencies)
+
+    def record(self, latency: float) -> None:
+        """record a latency in seconds"""
+        self.latencies.append(latency)
+
+    def percentile(self, p: float) -> float | None:
+        """return the p-th percentile (0 to 100) of the recent latencies, None if nothing was recorded
+
+        args:
+            p: the percentile, e.g. 95 for the 95th percentile
+        """
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        # nearest-rank method
+        rank = max(1, round(p / 100 * len(latencies)))
+        return latencies[min(rank, len(latencies)) - 1]
@@ -1,8 +1,34 @@
+import argparse
+from pathlib import Path
+
+import const
+import data_io
+import kroki
+import metrics
+from pipeline import Pipeline, batch_models, run_batch
 from repl import REPL
+from request_trace import TraceWriter
 
 def main():
-    repl = REPL()
+    parser = argparse.ArgumentParser(description="natlagram, convert natural language to diagrams")
+    parser.add_argument("--profile", action="store_true", help="profile every request and write the profiles to temp/profiles")
+    parser.add_argument("--session", help="save the conversation under this id after every prompt, resuming it if it exists")
+    parser.add_argument("--trace", action="store_true", help="capture every request into a rotating JSON lines log, see replay.py")
+    parser.add_argument("--batch", type=Path, help="render diagrams for the prompts in this file, one per line, instead of starting the REPL")
+    args = parser.parse_args()
+
+    if args.batch is not None:
+        kroki.check_kroki_server()
+        prompts = [line.strip() for line in args.batch.read_text().splitlines() if line.strip()]
+        tracer = TraceWriter() if args.trace or const.TRACE_REQUESTS else None
+        run_batch(prompts, Pipeline(batch_models(), data_io.OutputStore(Path("temp"))),
+            profile_dir=Path("temp/profiles") if args.profile else None, tracer=tracer)
+        kroki.local_renderer.close()
+        metrics.write_metrics(Path("temp"))
+        return
+
+    repl = REPL(profile=args.profile, session_id=args.session, trace=args.trace or const.TRACE_REQUESTS)
     repl.start_repl()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
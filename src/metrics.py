@@ -0,0 +1,234 @@
+"""here lives lightweight instrumentation: counters, histograms and timing spans, exportable as Prometheus text or JSON lines"""
+
+from contextlib import contextmanager
+import json
+import math
+from pathlib import Path
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, Iterator, List, Tuple
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+# upper bounds of histogram buckets, chosen by the unit at the end of a metric's name
+SECONDS_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, math.inf]
+TOKENS_BUCKETS = [100, 250, 500, 1000, 2000, 3000, 4000, 8000, math.inf]
+BYTES_BUCKETS = [2**20 * mebibytes for mebibytes in [16, 32, 64, 128, 256, 512, 1024, 2048, 4096]] + [math.inf]
+DEFAULT_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 1000, math.inf]
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def default_buckets(name: str) -> List[float]:
+    """return the histogram buckets for a metric based on its unit suffix"""
+    if name.endswith("_seconds"):
+        return SECONDS_BUCKETS
+    if name.endswith("_tokens"):
+        return TOKENS_BUCKETS
+    if name.endswith("_bytes"):
+        return BYTES_BUCKETS
+    return DEFAULT_BUCKETS
+
+class Histogram:
+    """cumulative histogram of observed values"""
+
+    def __init__(self, buckets: List[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+class Registry:
+    """thread-safe store of counters and histograms, keyed by metric name and labels"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """increment a counter
+
+        args:
+            name: the name of the counter, e.g. "natlagram_diagrams_total"
+            value: the amount to increment by
+            labels: labels distinguishing series of the counter, e.g. api="mermaid"
+        """
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """record a value in a histogram
+
+        args:
+            name: the name of the histogram, its suffix (e.g. "_seconds", "_tokens") selects the buckets
+            value: the observed value
+            labels: labels distinguishing series of the histogram, e.g. stage="llm_call"
+        """
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(default_buckets(name))
+            series[key].observe(value)
+
+    def reset(self) -> None:
+        """forget all recorded metrics"""
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def export_prometheus(self) -> str:
+        """return all metrics in the Prometheus text exposition format"""
+        def format_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{format_labels(labels)} {value:g}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        le = "+Inf" if bound == math.inf else f"{bound:g}"
+                        lines.append(f"{name}_bucket{format_labels(labels, (('le', le),))} {count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum:g}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def export_json_lines(self) -> str:
+        """return all metrics as JSON lines, one line per series"""
+        lines = []
+        timestamp = time.time()
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                for labels, value in sorted(series.items()):
+                    record = {"time": timestamp, "name": name, "type": "counter", "labels": dict(labels), "value": value}
+                    lines.append(json.dumps(record))
+            for name, series in sorted(self.histograms.items()):
+                for labels, histogram in sorted(series.items()):
+                    buckets = {("+Inf" if bound == math.inf else f"{bound:g}"): count for bound, count in zip(histogram.buckets, histogram.counts)}
+                    record = {"time": timestamp, "name": name, "type": "histogram", "labels": dict(labels),
+                        "count": histogram.count, "sum": histogram.sum, "buckets": buckets}
+                    lines.append(json.dumps(record))
+        return "\n".join(lines) + "\n"
+
+# the process-wide registry used by the module-level functions below
+registry = Registry()
+
+# per-thread collector of the stage timings of the current request, see collect_timings
+local = threading.local()
+
+def inc(name: str, value: float = 1, **labels: str) -> None:
+    """increment a counter in the process-wide registry"""
+    registry.inc(name, value, **labels)
+
+def observe(name: str, value: float, **labels: str) -> None:
+    """record a value in a histogram of the process-wide registry"""
+    registry.observe(name, value, **labels)
+
+@contextmanager
+def span(stage: str, **labels: str) -> Iterator[None]:
+    """time a pipeline stage and record its duration in natlagram_stage_seconds
+
+    args:
+        stage: the name of the stage, e.g. "llm_call" or "kroki_fetch"
+        labels: additional labels, e.g. api="mermaid"
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start_time
+        observe("natlagram_stage_seconds", duration, stage=stage, **labels)
+        timings = getattr(local, "timings", None)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + duration
+
+@contextmanager
+def collect_timings() -> Iterator[Dict[str, float]]:
+    """collect the total duration per stage of all spans in the current thread, e.g. for one request
+
+    yields:
+        a dictionary mapping stages to seconds, filled in as spans complete
+    """
+    previous = getattr(local, "timings", None)
+    local.timings = {}
+    try:
+        yield local.timings
+    finally:
+        local.timings = previous
+
+def max_rss_bytes() -> int | None:
+    """return the peak resident set size of the process so far, None where it is not available"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024 # kilobytes except on macOS
+
+@contextmanager
+def track_memory(allocations: bool = False, **labels: str) -> Iterator[Dict[str, int]]:
+    """record the memory high-water marks of a block, e.g. one request
+
+    The peak resident set size is that of the process so far, so that creep across requests shows in
+    natlagram_max_rss_bytes. With allocations, the peak of the Python heap during the block is traced into
+    natlagram_peak_traced_bytes as well.
+
+    args:
+        allocations: trace Python allocations with tracemalloc, which slows them down
+        labels: additional labels, e.g. mode="STATEFUL"
+
+    yields:
+        a dictionary that is filled with "max_rss_bytes" and "peak_traced_bytes" when the block exits
+    """
+    usage: Dict[str, int] = {}
+    if allocations:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    try:
+        yield usage
+    finally:
+        if allocations:
+            usage["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+            observe("natlagram_peak_traced_bytes", usage["peak_traced_bytes"], **labels)
+        max_rss = max_rss_bytes()
+        if max_rss is not None:
+            usage["max_rss_bytes"] = max_rss
+            observe("natlagram_max_rss_bytes", max_rss, **labels)
+
+def write_metrics(directory: Path) -> Tuple[Path, Path]:
+    """write the process-wide metrics as Prometheus text and JSON lines
+
+    args:
+        directory: the directory to write metrics.prom and metrics.jsonl into
+
+    returns:
+        the paths to the Prometheus text file and the JSON lines file
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    prometheus = directory / "metrics.prom"
+    json_lines = directory / "metrics.jsonl"
+    prometheus.write_text(registry.export_prometheus())
+    with open(json_lines, "a") as f: # append, so that snapshots over time can be compared
+        f.write(registry.export_json_lines())
+    return prometheus, json_lines
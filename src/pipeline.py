@@ -0,0 +1,472 @@
+"""here lives a staged pipeline from prompts to stored diagrams
+
+    llm -> extract -> render -> validate -> convert -> store
+
+Each stage has a bounded queue and its own pool of worker threads, so that the network-bound stages (llm,
+render) and the CPU-bound conversion can be sized separately. When a queue is full, the stage feeding it
+blocks, which applies backpressure up to Pipeline.submit. The REPL, batch mode (see run_batch) and any
+server entry point submit requests and wait on the returned futures.
+"""
+
+from concurrent.futures import Future
+from contextlib import AbstractContextManager, nullcontext
+import cProfile
+from pathlib import Path
+import queue
+import threading
+from typing import Callable, Dict, List, Tuple
+
+import canonical
+from chatGPT_official import InteractionMode, Model
+import const
+import data_io
+import kroki
+import metrics
+import primer_bundle
+import profiling
+from request_trace import TraceWriter, build_record
+from router import ApiRouter
+from scheduler import Priority, RequestScheduler
+import tokens
+
+STOP = None # sentinel that makes a stage's worker exit
+
+class Request:
+    """a prompt passing through the pipeline
+
+    args:
+        prompt: the user prompt
+        temperature: the temperature to sample with, None for the model's default
+        n: the number of candidates to generate, None for the model's default
+        texts: responses generated beforehand, which skip the llm stage
+        profile: profile the work of every thread on the request, see profiling.profiled
+    """
+
+    def __init__(self, prompt: str, temperature: float | None = None, n: int | None = None, texts: List[str] | None = None,
+        profile: bool = False) -> None:
+        self.prompt = prompt
+        self.temperature = temperature
+        self.n = n
+        self.texts = texts
+        self.extracted: List[Tuple[str, str]] | None = None # a (api, code) tuple per text, if extracted beforehand
+        self.profilers: List[cProfile.Profile] | None = [] if profile else None
+        self.prompt_tokens = 0 # the number of tokens of the messages sent for the prompt, set by the llm stage
+        self.candidates: List[Candidate] = []
+        self.pending = 0 # the number of unique candidates that have not been validated yet
+        self.unstored = 0 # the number of unique candidates that have not been stored or rejected yet
+        self.finished = False # whether the request leaves the pipeline without candidates
+        self.timings: Dict[str, float] = {} # seconds per stage, summed over candidates, guarded by lock
+        self.lock = threading.Lock()
+        self.future: Future = Future() # resolves to the candidates once all of them are validated
+        self.done: Future = Future() # resolves to the candidates once all of them are stored or rejected
+
+    def record(self, timings: Dict[str, float]) -> None:
+        """add the stage timings of a worker to the request's timings"""
+        with self.lock:
+            for stage, duration in timings.items():
+                self.timings[stage] = self.timings.get(stage, 0.0) + duration
+
+    def profile(self) -> AbstractContextManager:
+        """return a context that profiles the calling thread's work on the request, if the request is profiled"""
+        if self.profilers is None:
+            return nullcontext()
+        return profiling.profiled(self.profilers)
+
+    def timings_snapshot(self) -> Dict[str, float]:
+        """return a copy of the request's timings, workers may still be adding to them"""
+        with self.lock:
+            return dict(self.timings)
+
+    def validated(self) -> None:
+        """count a unique candidate as validated and resolve the request when it was the last one"""
+        with self.lock:
+            self.pending -= 1
+            done = self.pending == 0
+        if done:
+            self.resolve()
+
+    def resolve(self) -> None:
+        """copy the results of each unique candidate to its duplicates and resolve the request"""
+        for candidate in self.candidates:
+            if candidate.duplicate_of is not None:
+                first = self.candidates[candidate.duplicate_of]
+                candidate.svg_content = first.svg_content
+                candidate.valid = first.valid
+                candidate.error = first.error
+                candidate.preview = first.preview
+                candidate.stored = first.stored
+        unique = [candidate for candidate in self.candidates if candidate.duplicate_of is None]
+        self.unstored = len(unique)
+        self.future.set_result(self.candidates)
+        if not unique:
+            self.done.set_result(self.candidates)
+        for candidate in unique:
+            candidate.stored.add_done_callback(self.count_stored)
+
+    def count_stored(self, stored: Future) -> None:
+        """count a unique candidate as stored or rejected and finish the request when it was the last one"""
+        with self.lock:
+            self.unstored -= 1
+            done = self.unstored == 0
+        if done:
+            self.done.set_result(self.candidates)
+
+    def finish(self) -> None:
+        """finish a request that leaves the pipeline without candidates"""
+        self.resolve()
+
+    def fail(self, error: Exception) -> None:
+        """fail the request, e.g. when the model raised"""
+        if not self.future.done():
+            self.future.set_exception(error)
+            self.done.set_exception(error)
+
+class Candidate:
+    """one candidate response of a request, filled in as it passes through the stages
+
+    args:
+        request: the request the candidate was generated for
+        index: the index of the candidate among the request's candidates
+        text: the model's response text
+    """
+
+    def __init__(self, request: Request, index: int, text: str) -> None:
+        self.request = request
+        self.index = index
+        self.text = text
+        self.code = ""
+        self.api = ""
+        self.duplicate_of: int | None = None # the index of an equivalent candidate that is rendered instead
+        self.svg_content: bytes | None = None
+        self.valid = False
+        self.error: Exception | None = None # why the candidate could not be rendered, if not because it is invalid
+        self.validated = False
+        self.finished = False # whether the candidate leaves the pipeline, rejected or stored
+        self.converted: Dict[str, bytes] = {} # converted images by format, dropped once stored
+        self.artifacts: Dict[str, Path] = {} # the paths of the stored files by format
+        self.preview: Future = Future() # resolves to the low-resolution PNG preview, None if invalid or failed
+        self.stored: Future = Future() # resolves to the paths of the stored files by format, empty if invalid
+
+    def record(self, timings: Dict[str, float]) -> None:
+        """add the stage timings of a worker to the request's timings"""
+        self.request.record(timings)
+
+    def finish_validation(self, valid: bool) -> None:
+        """record whether the candidate is valid, invalid candidates are done"""
+        self.valid = valid
+        self.validated = True
+        if not valid:
+            self.preview.set_result(None)
+            self.stored.set_result({})
+        self.request.validated()
+
+    def finish(self) -> None:
+        """finish a candidate that leaves the pipeline, rejected before validation or stored after it"""
+        if not self.validated:
+            self.finish_validation(False)
+        else:
+            self.stored.set_result(self.artifacts)
+
+    def fail(self, error: Exception) -> None:
+        """fail the candidate, before or after it was validated"""
+        self.error = error
+        if not self.validated:
+            self.finish_validation(False)
+        elif not self.stored.done():
+            if not self.preview.done():
+                self.preview.set_result(None)
+            self.stored.set_exception(error)
+
+class Stage:
+    """a bounded queue served by a pool of worker threads
+
+    args:
+        name: the name of the stage, also the name of its span
+        work: processes an item on the given worker and returns the items for the next stage
+        workers: the number of worker threads
+        queue_size: the number of items waiting, beyond which put blocks
+    """
+
+    def __init__(self, name: str, work: Callable[[int, object], List[object]], workers: int, queue_size: int) -> None:
+        self.name = name
+        self.work = work
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.next: Stage | None = None
+        self.threads = [threading.Thread(target=self.serve, args=(worker,), name=f"pipeline-{name}-{worker}", daemon=True)
+            for worker in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item: object) -> None:
+        """enqueue an item, blocking while the queue is full"""
+        metrics.observe("natlagram_queue_depth", self.queue.qsize(), stage=self.name)
+        self.queue.put(item)
+
+    def serve(self, worker: int) -> None:
+        """process items until the stage is stopped"""
+        while True:
+            item = self.queue.get()
+            if item is STOP:
+                return
+            outputs = []
+            error = None
+            request = item if isinstance(item, Request) else item.request
+            with metrics.collect_timings() as timings:
+                try:
+                    with metrics.span(self.name), request.profile():
+                        outputs = self.work(worker, item)
+                except Exception as e:
+                    metrics.inc("natlagram_pipeline_errors_total", stage=self.name)
+                    error = e
+            # record before anything leaves the stage, so that a request's timings are complete once it is done
+            item.record(timings)
+            if error is not None:
+                item.fail(error)
+            for output in outputs:
+                if output.finished:
+                    output.finish()
+                else:
+                    self.next.put(output)
+
+    def stop(self) -> None:
+        """let the workers finish the queued items and exit"""
+        for _ in self.threads:
+            self.queue.put(STOP)
+        for thread in self.threads:
+            thread.join()
+
+class Pipeline:
+    """turn prompts into stored diagrams in stages
+
+    args:
+        models: the models generating responses, one llm worker per model since a model is not thread-safe,
+            empty if only code is submitted, see submit_code
+        store: the output store to save the images in
+        workers: the number of worker threads of each of the other stages
+        queue_size: the number of items waiting per stage
+        ready: events per diagram API, set once the API's renderer is warmed up. The render stage waits for the event
+            of a candidate's API so that no request pays the cold-start cost, APIs without an event don't wait
+    """
+
+    def __init__(self, models: List[Model], store: data_io.OutputStore,
+        workers: Dict[str, int] = const.PIPELINE_WORKERS, queue_size: int = const.PIPELINE_QUEUE_SIZE,
+        ready: Dict[str, threading.Event] | None = None) -> None:
+        self.models = models
+        self.store = store
+        self.ready = ready
+        self.stages = [
+            Stage("llm", self.generate, len(models), queue_size),
+            Stage("extract", self.extract, workers["extract"], queue_size),
+            Stage("render", self.render, workers["render"], queue_size),
+            Stage("validate", self.validate, workers["validate"], queue_size),
+            Stage("convert", self.convert, workers["convert"], queue_size),
+            Stage("store", self.save, workers["store"], queue_size),
+        ]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next = next_stage
+
+    def submit(self, prompt: str, temperature: float | None = None, n: int | None = None, profile: bool = False) -> Request:
+        """generate and render candidates for a prompt, blocking while the pipeline is full
+
+        args:
+            prompt: the user prompt
+            temperature: the temperature to sample with, None for the model's default
+            n: the number of candidates to generate, None for the model's default
+            profile: profile the request in every stage
+
+        returns:
+            the request, whose future resolves to its candidates once they are validated
+        """
+        request = Request(prompt, temperature, n, profile=profile)
+        self.stages[0].put(request)
+        return request
+
+    def submit_texts(self, prompt: str, texts: List[str]) -> Request:
+        """render responses that were generated beforehand, e.g. retries
+
+        args:
+            prompt: the user prompt the responses were generated for
+            texts: the model's response texts
+
+        returns:
+            the request, whose future resolves to its candidates once they are validated
+        """
+        request = Request(prompt, texts=texts)
+        self.stages[1].put(request)
+        return request
+
+    def submit_code(self, prompt: str, candidates: List[Tuple[str, str]]) -> Request:
+        """render candidates whose code was extracted beforehand, e.g. replayed from a trace, no model is needed
+
+        args:
+            prompt: the user prompt the candidates were generated for
+            candidates: a (api, code) tuple per candidate
+
+        returns:
+            the request, whose future resolves to its candidates once they are validated
+        """
+        request = Request(prompt, texts=[code for _, code in candidates])
+        request.extracted = candidates
+        self.stages[1].put(request)
+        return request
+
+    def generate(self, worker: int, request: Request) -> List[Request]:
+        """generate the responses of a request with the worker's model"""
+        model = self.models[worker]
+        request.prompt_tokens = model.estimate_tokens(request.prompt)
+        request.texts = model.generate_message(request.prompt, request.temperature, request.n)
+        return [request]
+
+    def extract(self, worker: int, request: Request) -> List[Candidate]:
+        """extract code and API of each response and pass on one candidate per unique diagram"""
+        for i, text in enumerate(request.texts):
+            candidate = Candidate(request, i, text)
+            if request.extracted is not None:
+                candidate.api, candidate.code = request.extracted[i]
+            else:
+                model = self.models[0] # extraction doesn't touch the model's state
+                try:
+                    candidate.code = model.extract_code_from_response(text)
+                    candidate.api = model.extract_diagram_api_from_response(text)
+                except ValueError:
+                    candidate.code, candidate.api = "", ""
+            request.candidates.append(candidate)
+
+        unique = []
+        groups = canonical.group_candidates([(candidate.api, candidate.code) for candidate in request.candidates])
+        for indices in groups:
+            unique.append(request.candidates[indices[0]])
+            for i in indices[1:]:
+                request.candidates[i].duplicate_of = indices[0]
+            if len(indices) > 1:
+                metrics.inc("natlagram_duplicate_candidates_total", len(indices) - 1, api=request.candidates[indices[0]].api)
+        request.pending = len(unique)
+        if not unique:
+            request.finished = True
+            return [request]
+        return unique
+
+    def render(self, worker: int, candidate: Candidate) -> List[Candidate]:
+        """render a candidate's SVG image"""
+        warmed_up = self.ready.get(candidate.api) if self.ready is not None else None
+        if warmed_up is not None and not warmed_up.is_set():
+            print(f"Waiting for {candidate.api} to warm up...")
+            warmed_up.wait()
+        if not candidate.code or not candidate.api:
+            self.reject(candidate)
+            return [candidate]
+        try:
+            candidate.svg_content = kroki.render_diagram(candidate.code, candidate.api, "svg")
+        except kroki.RenderError:
+            self.reject(candidate)
+        except kroki.RendererUnavailable as e:
+            candidate.error = e
+            self.reject(candidate)
+        return [candidate]
+
+    def validate(self, worker: int, candidate: Candidate) -> List[Candidate]:
+        """check whether a candidate's image shows a diagram rather than an error message"""
+        if not kroki.check_content_valid(candidate.svg_content.decode("utf-8", errors="replace"), candidate.api, candidate.code):
+            self.reject(candidate)
+            return [candidate]
+        metrics.inc("natlagram_diagrams_total", api=candidate.api, valid="true")
+        candidate.finish_validation(True)
+        return [candidate]
+
+    def reject(self, candidate: Candidate) -> None:
+        """let an invalid candidate leave the pipeline"""
+        metrics.inc("natlagram_diagrams_total", api=candidate.api, valid="false")
+        candidate.finished = True
+
+    def convert(self, worker: int, candidate: Candidate) -> List[Candidate]:
+        """convert a valid candidate's SVG image into the preview, the PDF and the full-resolution PNG"""
+        preview = kroki.convert_svg_content_to_preview(candidate.svg_content)
+        candidate.preview.set_result(preview) # shown while the rest is converted
+        candidate.converted = {
+            "preview": preview,
+            "pdf": kroki.print_svg_content(candidate.svg_content),
+            "png": kroki.convert_svg_content_to_png(candidate.svg_content),
+        }
+        return [candidate]
+
+    def save(self, worker: int, candidate: Candidate) -> List[Candidate]:
+        """write a candidate's images into the store and index them"""
+        suffixes = {"svg": ".svg", "preview": ".preview.png", "pdf": ".pdf", "png": ".png"}
+        contents = {"svg": candidate.svg_content, **candidate.converted}
+        key = self.store.key(candidate.api, candidate.code)
+        artifacts = {}
+        for name, content in contents.items():
+            artifacts[name] = self.store.path(key, candidate.api, suffixes[name])
+            self.store.write_bytes(artifacts[name], content)
+        self.store.add_to_index(candidate.request.prompt, candidate.api, key, artifacts)
+        candidate.converted = {}
+        candidate.artifacts = artifacts
+        candidate.finished = True
+        return [candidate]
+
+    def close(self) -> None:
+        """finish all submitted requests and stop the workers"""
+        for stage in self.stages: # upstream first, so that each stage has received all of its items when it stops
+            stage.stop()
+
+def batch_models(count: int = const.BATCH_MODELS) -> List[Model]:
+    """return stateless models for batch mode, which share the primer bundle, router and rate limits
+
+    args:
+        count: the number of models, i.e. concurrent openai requests
+    """
+    bundle = primer_bundle.load_bundle(compact=const.COMPACT_PRIMERS)
+    router = ApiRouter.train() if const.ROUTE_PRIMERS else None
+    scheduler = RequestScheduler()
+    models = []
+    for _ in range(count):
+        model = Model(scheduler=scheduler, priority=Priority.BATCH)
+        model.load_bundle(bundle)
+        model.router = router
+        model.set_interaction_mode(InteractionMode.STATELESS)
+        models.append(model)
+    return models
+
+def trace_record(request: Request, model: Model, mode: str, timings: Dict[str, float] | None = None, memory: Dict[str, int] | None = None) -> Dict:
+    """build the trace record of a done request, see request_trace.build_record
+
+    args:
+        request: the done request
+        model: the model that generated the request's candidates
+        mode: the interaction mode the request was submitted in, e.g. "STATELESS"
+        timings: seconds per stage spent outside of the pipeline, e.g. on the REPL's thread
+        memory: the memory high-water marks of the request, see metrics.track_memory
+    """
+    all_timings = request.timings_snapshot()
+    for stage, duration in (timings or {}).items():
+        all_timings[stage] = all_timings.get(stage, 0.0) + duration
+    candidates = [{"api": candidate.api, "code": candidate.code, "valid": candidate.valid} for candidate in request.candidates]
+    completion_tokens = sum(tokens.count_message_tokens({"role": "assistant", "content": candidate.text}, model.model)
+        for candidate in request.candidates)
+    return build_record(request.prompt, mode, model.model,
+        request.temperature if request.temperature is not None else model.temperature, request.n if request.n is not None else model.n,
+        candidates, all_timings, request.prompt_tokens, completion_tokens, memory)
+
+def run_batch(prompts: List[str], pipeline: Pipeline, profile_dir: Path | None = None, tracer: TraceWriter | None = None) -> None:
+    """render diagrams for many prompts and print a summary
+
+    args:
+        prompts: the user prompts
+        pipeline: the pipeline to submit the prompts to, closed when all of them are done
+        profile_dir: profile all requests into one profile written to this directory, None to not profile
+        tracer: capture every request into this trace, None to not trace
+    """
+    requests = [pipeline.submit(prompt, profile=profile_dir is not None) for prompt in prompts]
+    pipeline.close()
+    if profile_dir is not None:
+        profiling.write_profile([profiler for request in requests for profiler in request.profilers], profile_dir)
+    for request in requests:
+        if tracer is not None and request.done.exception() is None:
+            tracer.write(trace_record(request, pipeline.models[0], InteractionMode.STATELESS.name))
+        if request.future.exception() is not None:
+            print(f"Failed: {request.prompt!r}: {request.future.exception()}")
+            continue
+        unique = [candidate for candidate in request.candidates if candidate.valid and candidate.duplicate_of is None]
+        files = ", ".join(str(candidate.stored.result()["svg"]) for candidate in unique if candidate.stored.exception() is None)
+        valid = sum(candidate.valid for candidate in request.candidates)
+        print(f"{valid}/{len(request.candidates)} valid: {request.prompt!r} {files}")
@@ -0,0 +1,147 @@
+"""here lives the primer bundle: primers and examples compiled into messages with precomputed token counts
+
+Build the bundle ahead of time with
+
+    python3 src/primer_bundle.py [--compact]
+
+Otherwise it is built on first use. A bundle is rebuilt whenever the primers, the examples file or the
+bundle format change, which is detected by a hash over all sources.
+"""
+
+import argparse
+import hashlib
+import json
+from pathlib import Path
+import re
+from typing import Dict, List
+
+import bot_primer
+from chatGPT import AbstractModel
+import data_io
+import tokens
+
+BUNDLE_VERSION = 1 # increment when the bundle format changes
+BUNDLE_DIR = Path("resources")
+ACK_REQUEST = re.compile(r'\s*Respond "ACK" if you understand\.\s*$')
+
+def bundle_path(compact: bool = False, directory: Path = BUNDLE_DIR) -> Path:
+    """return the path of the bundle
+
+    args:
+        compact: whether the primer dialogue is collapsed into a single system message
+        directory: the directory the bundle is stored in
+    """
+    return directory / ("primer_bundle_compact.json" if compact else "primer_bundle.json")
+
+def source_hash(problem_file: Path, compact: bool, model: str) -> str:
+    """return a hash over everything a bundle is compiled from
+
+    args:
+        problem_file: the file with the examples
+        compact: whether the primer dialogue is collapsed into a single system message
+        model: the model whose tokenizer counts the tokens
+    """
+    h = hashlib.sha256()
+    h.update(f"{BUNDLE_VERSION}\n{compact}\n{model}\n".encode("utf-8"))
+    for primer in bot_primer.basic_primers:
+        h.update(primer.encode("utf-8"))
+    h.update(Path(problem_file).read_bytes())
+    return h.hexdigest()
+
+def compile_primer_messages(compact: bool) -> List[Dict[str, str]]:
+    """return the primers as messages
+
+    args:
+        compact: collapse the multi-turn "Respond ACK" dialogue into a single system message
+    """
+    primers = bot_primer.basic_primers
+    if compact:
+        content = "\n".join(ACK_REQUEST.sub("", primer).strip() for primer in primers)
+        return [{"role": "system", "content": content}]
+    messages = [{"role": "system", "content": primers[0]}]
+    for primer in primers[1:]:
+        messages.append({"role": "user", "content": primer})
+        messages.append({"role": "assistant", "content": "ACK"})
+    return messages
+
+def compile_bundle(problem_file: Path = data_io.RESOURCES, compact: bool = False, model: str = "gpt-3.5-turbo") -> Dict:
+    """compile primers and examples into a bundle
+
+    args:
+        problem_file: the file with the examples
+        compact: collapse the multi-turn "Respond ACK" dialogue into a single system message
+        model: the model whose tokenizer counts the tokens
+
+    returns:
+        the bundle, a dictionary with the primer messages, the examples and the token count of every message
+    """
+    primers = compile_primer_messages(compact)
+    examples = []
+    parser = AbstractModel()
+    for problem, label in zip(*data_io.load_problems_and_labels(problem_file)):
+        messages = [{"role": "user", "content": problem}, {"role": "assistant", "content": label}]
+        examples.append({
+            "api": parser.extract_diagram_api_from_response(label),
+            "messages": messages,
+            "tokens": [tokens.count_message_tokens(message, model) for message in messages],
+        })
+    return {
+        "version": BUNDLE_VERSION,
+        "source_hash": source_hash(problem_file, compact, model),
+        "model": model,
+        "compact": compact,
+        "primers": primers,
+        "primer_tokens": [tokens.count_message_tokens(message, model) for message in primers],
+        "examples": examples,
+    }
+
+def write_bundle(bundle: Dict, path: Path) -> None:
+    """atomically write a bundle
+
+    args:
+        bundle: the bundle
+        path: the path of the bundle
+    """
+    with data_io.atomic_path(path) as temp_path:
+        temp_path.write_text(json.dumps(bundle, separators=(",", ":")))
+
+def load_bundle(compact: bool = False, problem_file: Path = data_io.RESOURCES, model: str = "gpt-3.5-turbo", directory: Path = BUNDLE_DIR) -> Dict:
+    """load a bundle in one read, (re)building it if it is missing or stale
+
+    args:
+        compact: whether the primer dialogue is collapsed into a single system message
+        problem_file: the file with the examples
+        model: the model whose tokenizer counts the tokens
+        directory: the directory the bundle is stored in
+
+    returns:
+        the bundle
+    """
+    path = bundle_path(compact, directory)
+    expected_hash = source_hash(problem_file, compact, model)
+    if path.exists():
+        bundle = json.loads(path.read_text())
+        if bundle.get("source_hash") == expected_hash:
+            return bundle
+    bundle = compile_bundle(problem_file, compact, model)
+    write_bundle(bundle, path)
+    return bundle
+
+def bundle_messages(bundle: Dict) -> List[Dict[str, str]]:
+    """return all messages of a bundle, primers first, then examples"""
+    messages = list(bundle["primers"])
+    for example in bundle["examples"]:
+        messages.extend(example["messages"])
+    return messages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compile primers and examples into a bundle")
+    parser.add_argument("--compact", action="store_true", help="collapse the primer dialogue into a single system message")
+    parser.add_argument("--problems", type=Path, default=data_io.RESOURCES, help="the file with the examples")
+    args = parser.parse_args()
+
+    bundle = compile_bundle(args.problems, args.compact)
+    path = bundle_path(args.compact)
+    write_bundle(bundle, path)
+    total = sum(bundle["primer_tokens"]) + sum(sum(example["tokens"]) for example in bundle["examples"])
+    print(f"Wrote {path} with {len(bundle['examples'])} examples and {total} tokens")
@@ -0,0 +1,68 @@
+"""here lives an opt-in profiling hook that explains individual slow requests"""
+
+import cProfile
+from contextlib import contextmanager
+import io
+from pathlib import Path
+import pstats
+import time
+from typing import Iterator, List
+
+@contextmanager
+def profiled(profilers: List[cProfile.Profile]) -> Iterator[None]:
+    """profile the calling thread while the block runs and append the profile to profilers
+
+    A request is worked on by several pipeline threads, each of them profiles its share into the request's
+    list of profilers, see write_profile.
+
+    NOTE: the openai request itself runs in a child process, so its share of the time shows up as waiting in
+    the llm stage. Since Python 3.12 only one profiler can be active per process, and it sees every thread:
+    while another block is profiled, this block isn't profiled separately but shows up in the active profile.
+
+    args:
+        profilers: the list to append the profile to, appending is atomic
+    """
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        enabled = True
+    except ValueError: # another profiler is active
+        enabled = False
+    try:
+        yield
+    finally:
+        if enabled:
+            profiler.disable()
+            profilers.append(profiler)
+
+def write_profile(profilers: List[cProfile.Profile], output_dir: Path, top_n: int = 20) -> Path | None:
+    """merge profiles, write them and print a summary of the hottest functions
+
+    args:
+        profilers: the profiles to merge, e.g. of all threads that worked on a request
+        output_dir: the directory to write the .prof file and the summary into
+        top_n: the number of functions in the summary
+
+    returns:
+        the path to the .prof file, None if nothing was profiled
+    """
+    if not profilers:
+        print("Nothing was profiled.")
+        return None
+    output_dir.mkdir(parents=True, exist_ok=True)
+    name = f"profile_{time.strftime('%Y%m%d_%H%M%S')}_{time.time_ns() % 1000000:06d}"
+    profile_path = output_dir / f"{name}.prof"
+    summary_path = output_dir / f"{name}.txt"
+
+    summary = io.StringIO()
+    stats = pstats.Stats(*profilers, stream=summary)
+    stats.dump_stats(profile_path)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top_n)
+    summary_path.write_text(summary.getvalue())
+
+    # print only the table, the header of pstats' output repeats what we already know
+    table = summary.getvalue().split("ncalls", 1)
+    print(f"Top {top_n} functions by cumulative time:")
+    print("   ncalls" + table[1] if len(table) == 2 else summary.getvalue())
+    print(f"Profile written to {profile_path}, summary to {summary_path}")
+    return profile_path
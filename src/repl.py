@@ -1,27 +1,101 @@
 """this module contains the REPL class, which is used to interact with the chatbot in the terminal."""
 
+from concurrent.futures import Future, wait
+import io
+import threading
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, Tuple
 
 import chatGPT_official as chatGPT
 from chatGPT_official import InteractionMode
 import kroki
 import const
+import data_io
+import metrics
+import primer_bundle
+import profiling
+import tokens
+from router import ApiRouter
+from sampling import SamplingPolicy, ValidityStats
+from session import SessionStore
+from pipeline import Candidate, Pipeline, trace_record
+from request_trace import TraceWriter
+from scheduler import RequestError, RequestScheduler
 
 class REPL:
     """read-eval-print loop for interacting with the chatbot in the terminal"""
 
-    def __init__(self) -> None:
+    def __init__(self, profile: bool = False, session_id: str | None = None, trace: bool = const.TRACE_REQUESTS) -> None:
+        """
+        args:
+            profile: profile every request, otherwise only requests preceded by the 'profile' command are profiled
+            session_id: save the conversation under this id after every prompt, resuming it if it exists
+            trace: capture every request into a rotating JSON lines log
+        """
         kroki.check_kroki_server()
-        self.chatbot = chatGPT.Model()
-        self.chatbot.load_primers()
-        if const.DEBUG == False:
-            self.chatbot.load_examples()
+        self.warm_up_latencies: Dict[str, Tuple[float, float]] = {}
+        self.warmed_up: Dict[str, threading.Event] = {} # per diagram API, the pipeline's render stage waits for them
+        if const.WARM_UP_KROKI:
+            self.warmed_up = {api: threading.Event() for api in [*const.SERVICES, *kroki.local_renderer.commands]}
+            threading.Thread(target=self.warm_up, daemon=True).start()
+        self.chatbot = chatGPT.Model(scheduler=RequestScheduler())
+        if const.DEBUG == False and const.USE_PRIMER_BUNDLE:
+            self.chatbot.load_bundle(primer_bundle.load_bundle(compact=const.COMPACT_PRIMERS))
+            if const.ROUTE_PRIMERS:
+                self.chatbot.router = ApiRouter.train()
+        else:
+            self.chatbot.load_primers()
+            if const.DEBUG == False:
+                self.chatbot.load_examples()
         self.chatbot.backup_messages()
+
+        self.sessions = SessionStore()
+        self.session_id = session_id
+        if session_id is not None and self.sessions.exists(session_id):
+            try:
+                self.sessions.restore(session_id, self.chatbot)
+                print(f"Resumed session {session_id} in interaction mode {self.chatbot.interaction_mode}")
+            except ValueError as e:
+                print(f"Warning: could not resume session {session_id}, starting a new one. {e}")
+
         self.workdir = Path("temp")
+        self.store = data_io.OutputStore(self.workdir)
+        self.pipeline = Pipeline([self.chatbot], self.store, ready=self.warmed_up)
+        self.profile_all = profile
+        self.profile_next = False
+        self.tracer: TraceWriter | None = TraceWriter() if trace else None
+        self.sampling: SamplingPolicy | None = None
+        if const.ADAPTIVE_SAMPLING:
+            self.sampling = SamplingPolicy(ValidityStats())
+
+        num_tokens = self.chatbot.estimate_tokens()
+        print(f"Estimated tokens: {num_tokens}")
 
-        tokens = self.chatbot.estimate_tokens()
-        print(f"Estimated tokens: {tokens}")
+    def warm_up(self) -> None:
+        """warm up the local renderers and the kroki services and record the latter's cold and warm latencies, runs in the background
+
+        An API is ready as soon as the renderer it is rendered with first is warm, see kroki.renderers.
+        """
+        try:
+            try:
+                kroki.local_renderer.warm_up()
+            except OSError as e:
+                print(f"\nCould not warm up the local renderers: {e}")
+            else:
+                for api in kroki.local_renderer.commands:
+                    self.warmed_up[api].set()
+            self.warm_up_latencies = kroki.warm_up_services(ready=self.warmed_up)
+        finally:
+            for warmed_up in self.warmed_up.values(): # don't keep renders waiting if the warm-up failed
+                warmed_up.set()
+        slowest = sorted(self.warm_up_latencies.items(), key=lambda item: item[1][0], reverse=True)[:3]
+        summary = ", ".join(f"{service} {cold:.1f}s/{warm:.1f}s" for service, (cold, warm) in slowest)
+        print(f"\nWarmed up {len(self.warm_up_latencies)} Kroki services (slowest cold/warm: {summary})")
+
+    def export_metrics(self) -> None:
+        """write the metrics collected so far into the working directory"""
+        prometheus, json_lines = metrics.write_metrics(self.workdir)
+        print(f"Metrics written to {prometheus} and {json_lines}")
 
     def print_pretty_text(self, code: str, api: str, text: str, i: int) -> None:
         """print the model's response text and extracted code and API without redundancy
@@ -38,13 +112,29 @@ class REPL:
         else:
             print(f"Text [{i}]: {text}")
 
-    def generate_image(self, text: str, i: int, retry: int = 0) -> bool:
+    def generate_image(self, text: str, i: int, retry: int = 0, prompt: str = "") -> bool:
         """generate an image from a model's response
         
         args:
             text: the text extracted from the model's response 
             i: the index of the message, if multiple messages were generated from a single user prompt
             retry: the number of times the image generation has been retried for a given user input
+            prompt: the user prompt that the response was generated for
+
+        returns:
+            True if the image was generated successfully, False otherwise
+        """
+        request = self.pipeline.submit_texts(prompt, [text])
+        candidate = request.future.result()[0] # there is only one candidate
+        return self.report_candidate(candidate, i, retry)
+
+    def report_candidate(self, candidate: Candidate, i: int, retry: int = 0) -> bool:
+        """print a candidate that went through the pipeline and show its preview, its files are stored in the background
+        
+        args:
+            candidate: the validated candidate
+            i: the index of the message, if multiple messages were generated from a single user prompt
+            retry: the number of times the image generation has been retried for a given user input
 
         returns:
             True if the image was generated successfully, False otherwise
@@ -54,25 +144,21 @@ class REPL:
             print(f"Bot response [{i}], retry [{retry}]:")
         else:
             print(f"Bot response [{i}]:")
-        try:
-            code = self.chatbot.extract_code_from_response(text)
-            api = self.chatbot.extract_diagram_api_from_response(text)
-        except:
-            code = ""
-            api = ""
-        self.print_pretty_text(code, api, text, i)
+        self.print_pretty_text(candidate.code, candidate.api, candidate.text, i)
 
-        img_url = kroki.generate_url_from_str(code, api, "svg")
+        img_url = kroki.generate_url_from_str(candidate.code, candidate.api, "svg")
         print(f"URL [{i}]: {img_url}")
+        if candidate.error is not None:
+            print(candidate.error)
+        print(f"Valid [{i}]: {candidate.valid}")
 
-        valid = kroki.check_image_valid(img_url, api, code)
-        print(f"Valid [{i}]: {valid}")
-
-        if valid:
-            kroki.save_images(img_url, self.workdir, api, code)
-            return True
-
-        return False
+        if candidate.valid:
+            with metrics.span("show_preview", api=candidate.api):
+                preview = candidate.preview.result() # converted by the pipeline, None if the conversion failed
+                if preview is not None:
+                    kroki.show_png(io.BytesIO(preview), block=False)
+            candidate.stored.add_done_callback(kroki.report_artifact_failure)
+        return candidate.valid
 
     def retry_with_hi_temp(self, prompt: str) -> str:
         """generate a message with a higher temperature
@@ -81,8 +167,12 @@ class REPL:
             prompt: the user prompt to generate a message from
         """
         hi_temp = self.chatbot.get_hi_temp()
-        texts = self.chatbot.generate_message(prompt, temperature=hi_temp, n=1) # generate only one message
-        return texts[0] # there is only one text in the list
+        try:
+            texts = self.chatbot.generate_message(prompt, temperature=hi_temp, n=1) # generate only one message
+        except RequestError as e:
+            print(f"The model did not respond: {e}")
+            return ""
+        return texts[0] if texts else "" # there is at most one text in the list
 
     def handle_special_prompt_cases(self, prompt: str) -> Tuple[bool, str]:
         """handle a user prompt on the surface level
@@ -93,16 +183,22 @@ class REPL:
                     1) "exit": quit REPL
                     2) "multiline": enter multiline queries
                     3) ["stateless", "improve", "stateful"]: change interaction mode
+                    4) "metrics": export the metrics collected so far
+                    5) "profile": profile the next request
         
         returns: 
             a tuple with
-                a boolean indicating whether the interaction mode was modified
+                a boolean indicating whether the prompt was handled, e.g. the interaction mode was modified
                 the user prompt, optionally modified
         """
         old_mode = self.chatbot.interaction_mode
         changed = False
 
         if prompt == "exit":
+            print("Waiting for images to be saved...")
+            self.pipeline.close()
+            kroki.local_renderer.close()
+            self.export_metrics()
             exit()
         if prompt == "multiline":
             print("Enter your multiline prompt. Type 'end' to finish.")
@@ -119,6 +215,14 @@ class REPL:
             self.chatbot.set_interaction_mode(InteractionMode.IMPROVING)
         elif prompt == "stateful":
             self.chatbot.set_interaction_mode(InteractionMode.STATEFUL)
+        elif prompt == "metrics":
+            print(metrics.registry.export_prometheus())
+            self.export_metrics()
+            return True, prompt
+        elif prompt == "profile":
+            self.profile_next = True
+            print("The next request will be profiled.")
+            return True, prompt
 
         if old_mode != self.chatbot.interaction_mode:
             changed = True
@@ -141,9 +245,17 @@ class REPL:
 
         def try_again() -> None:
             """user wants to try again"""
-            texts = self.chatbot.generate_message(prompt, n=1) # generate only one message
+            try:
+                texts = self.chatbot.generate_message(prompt, n=1) # generate only one message
+            except RequestError as e:
+                print(f"The model did not respond: {e}")
+                return
+            if not texts:
+                print("The model did not respond.")
+                return
             text = texts[0] # there is only one text in the list
-            success = self.generate_image(text, i, retry + 1) # increment failure's index by 10 to avoid overlap with original messages
+            metrics.inc("natlagram_retries_total", kind="repl")
+            success = self.generate_image(text, i, retry + 1, prompt) # increment failure's index by 10 to avoid overlap with original messages
             self.handle_failure(prompt, success, i, retry + 1)
 
         if self.chatbot.interaction_mode == InteractionMode.STATELESS:
@@ -185,17 +297,111 @@ class REPL:
         print("Type 'exit' to exit the REPL.")
         print(f"Type 'stateless', 'improve' or 'stateful' to change interaction mode. Default {self.chatbot.interaction_mode}.")
         print(f"Type 'multiline' to enter multiline queries.")
+        print(f"Type 'metrics' to export timing and validity metrics.")
+        print(f"Type 'profile' to profile the next request.")
         
         while True:
             prompt = input("User: ")
             mode_changed, prompt = self.handle_special_prompt_cases(prompt)
             if mode_changed:
+                self.save_session()
                 continue
-            
-            texts = self.chatbot.generate_message(prompt) # generated n responses by the model
-            for i, text in enumerate(texts):
-                success = self.generate_image(text, i)
-                self.handle_failure(prompt, success, i)
+
+            profile = self.profile_all or self.profile_next
+            self.profile_next = False
+            self.handle_prompt(prompt, profile)
+            self.save_session()
+
+    def save_session(self) -> None:
+        """save the conversation, if the REPL was started with a session id"""
+        if self.session_id is not None:
+            self.sessions.save(self.session_id, self.chatbot)
+
+    def handle_prompt(self, prompt: str, profile: bool = False) -> None:
+        """generate images for a user prompt, end to end
+        
+        args:
+            prompt: the user prompt
+            profile: profile the request on the REPL's and the pipeline's threads and write the profile once it is stored
+        """
+        category = self.categorize(prompt)
+        n, temperature = None, None # the model's defaults
+        if self.sampling is not None:
+            # a stateful conversation keeps every reply in its history, so only stateless requests sample several
+            max_n = None if self.chatbot.interaction_mode == InteractionMode.STATELESS else 1
+            choice = self.sampling.choose(category, self.chatbot.estimate_tokens(prompt), max_n)
+            if choice is not None:
+                n, temperature = choice
+                print(f"Sampling {n} candidate(s) at temperature {temperature}")
+
+        with metrics.collect_timings() as timings, metrics.track_memory(allocations=const.TRACE_ALLOCATIONS) as memory:
+            mode = self.chatbot.interaction_mode.name
+            request = self.pipeline.submit(prompt, temperature, n, profile) # generates n responses by the model
+            try:
+                results = request.future.result()
+            except RequestError as e: # rejected, or still failing after the scheduler's retries
+                print(f"OpenAI request failed: {e}")
+                results = []
+            latency = request.timings_snapshot().get("llm", 0.0)
+            if not results:
+                print("The model did not respond. Please try again.")
+            with request.profile():
+                for candidate in results: # equivalent candidates were rendered once, see canonical.py
+                    if candidate.duplicate_of is not None:
+                        continue
+                    self.report_candidate(candidate, candidate.index)
+                    duplicates = [other.index for other in results if other.duplicate_of == candidate.index]
+                    if duplicates:
+                        print(f"Bot responses {duplicates} are equivalent to [{candidate.index}], valid: {candidate.valid}")
+                    self.handle_failure(prompt, candidate.valid, candidate.index)
+
+            if self.sampling is not None:
+                for candidate in results:
+                    self.record_sampling(category, candidate.text, temperature, candidate.valid, latency)
+        if const.MEMORY_BOUNDED and "max_rss_bytes" in memory: # always recorded in the metrics and the trace
+            print(f"Peak memory: {memory['max_rss_bytes'] / 2**20:.0f} MiB")
+
+        if self.tracer is not None:
+            # conversion and storage continue on the pipeline's threads, trace the request once they are done
+            def write_trace(done: Future) -> None:
+                if done.exception() is None:
+                    self.tracer.write(trace_record(request, self.chatbot, mode, timings, memory))
+            request.done.add_done_callback(write_trace)
+
+        if profile:
+            print("Waiting for images to be saved...")
+            wait([request.done])
+            profiling.write_profile(request.profilers, self.workdir / "profiles")
+
+    def categorize(self, prompt: str) -> str:
+        """return the category of a prompt, the API family predicted by the router or "unknown" without a router
+        
+        args:
+            prompt: the user prompt
+        """
+        if self.chatbot.router is None:
+            return "unknown"
+        family, _ = self.chatbot.router.predict(prompt)
+        return family
+
+    def record_sampling(self, category: str, text: str, temperature: float | None, success: bool, latency: float) -> None:
+        """record the outcome of a candidate in the sampling statistics
+        
+        args:
+            category: the category of the prompt
+            text: the candidate's text
+            temperature: the temperature the candidate was sampled with, None for the model's default
+            success: whether an image was generated from the candidate
+            latency: the latency of the request that generated the candidate in seconds
+        """
+        if temperature is None:
+            temperature = self.chatbot.temperature
+        try:
+            api = self.chatbot.extract_diagram_api_from_response(text)
+        except ValueError:
+            api = ""
+        completion_tokens = tokens.count_message_tokens({"role": "assistant", "content": text}, self.chatbot.model)
+        self.sampling.stats.record(category, api, temperature, success, latency, completion_tokens)
 
 if __name__ == "__main__":
     repl = REPL()
@@ -0,0 +1,91 @@
+"""here lives a tool that replays a captured request trace against the pipeline, to reproduce production load offline
+
+    python3 src/replay.py temp/traces/trace.jsonl --speed 10 --concurrency 8
+
+Requests are submitted at their original pace divided by the speed-up, to a pipeline with a bounded number of
+openai requests and renders in flight. With --renders-only, the captured candidates are re-rendered without
+calling the openai API.
+"""
+
+import argparse
+from concurrent.futures import wait
+from pathlib import Path
+import time
+from typing import Dict, List
+
+import const
+import data_io
+import kroki
+from latency import LatencyWindow
+import metrics
+from pipeline import Pipeline, Request, batch_models
+from request_trace import read_traces
+
+def submit_record(pipeline: Pipeline, record: Dict, renders_only: bool) -> Request:
+    """submit one captured request to the pipeline, statelessly
+
+    args:
+        pipeline: the pipeline to replay the request on
+        record: the captured request, see request_trace.build_record
+        renders_only: re-render the captured candidates instead of generating new ones
+
+    returns:
+        the submitted request
+    """
+    if renders_only:
+        return pipeline.submit_code(record["prompt"], [(candidate["api"], candidate["code"]) for candidate in record["candidates"]])
+    return pipeline.submit(record["prompt"], record["temperature"], record["n"])
+
+def replay(records: List[Dict], speed: float, concurrency: int, renders_only: bool) -> None:
+    """replay captured requests and print a latency and validity summary
+
+    Generated requests use the configured model rather than the captured one, see pipeline.batch_models.
+
+    args:
+        records: the captured requests, oldest first
+        speed: the speed-up relative to the original pace, 0 to submit all requests at once
+        concurrency: the number of concurrent openai requests and renders
+        renders_only: re-render the captured candidates instead of generating new ones
+    """
+    models = [] if renders_only else batch_models(concurrency)
+    pipeline = Pipeline(models, data_io.OutputStore(Path("temp/replay")), workers=dict(const.PIPELINE_WORKERS, render=concurrency))
+    latencies = LatencyWindow(size=len(records))
+    requests: List[Request] = []
+
+    start_time = time.time()
+    first_time = records[0]["time"] if records else 0
+    for record in records:
+        if speed > 0:
+            delay = (record["time"] - first_time) / speed - (time.time() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+        submit_time = time.time()
+        request = submit_record(pipeline, record, renders_only)
+        request.done.add_done_callback(lambda done, submit_time=submit_time: latencies.record(time.time() - submit_time))
+        requests.append(request)
+    wait([request.done for request in requests])
+    duration = time.time() - start_time
+    pipeline.close()
+
+    failed = sum(1 for request in requests if request.done.exception() is not None)
+    valid = [candidate.valid for request in requests if request.done.exception() is None for candidate in request.candidates]
+    print(f"Replayed {len(records)} requests in {duration:.1f} seconds ({len(records) / max(duration, 1e-9):.2f} requests/s), {failed} failed")
+    if valid:
+        print(f"Valid candidates: {sum(valid)}/{len(valid)}")
+    if len(latencies):
+        print(f"Latency p50 {latencies.percentile(50):.2f}s, p95 {latencies.percentile(95):.2f}s, p99 {latencies.percentile(99):.2f}s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay a captured request trace against the pipeline")
+    parser.add_argument("trace", type=Path, help="a trace log written with --trace, see request_trace.py")
+    parser.add_argument("--speed", type=float, default=1, help="speed-up relative to the original pace, 0 submits all requests at once")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of concurrent openai requests and renders")
+    parser.add_argument("--limit", type=int, default=None, help="replay only the first N requests")
+    parser.add_argument("--renders-only", action="store_true", help="re-render the captured candidates without calling the openai API")
+    args = parser.parse_args()
+
+    records = read_traces(args.trace)[:args.limit]
+    replay(records, args.speed, args.concurrency, args.renders_only)
+    prometheus, json_lines = metrics.write_metrics(Path("temp/replay"))
+    print(f"Metrics written to {prometheus} and {json_lines}")
+    kroki.local_renderer.close()
@@ -0,0 +1,80 @@
+"""here lives structured capture of requests into a rotating JSON lines log, to be replayed with replay.py"""
+
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+import time
+from typing import Dict, List
+
+import const
+
+class TraceWriter:
+    """append one JSON line per request to a log file that is rotated by size
+
+    args:
+        path: the path of the log file, rotated files get the suffixes .1, .2, ...
+        max_bytes: the size at which the log file is rotated
+        backups: the number of rotated files to keep
+    """
+
+    def __init__(self, path: Path = Path(const.TRACE_FILE), max_bytes: int = const.TRACE_MAX_BYTES, backups: int = const.TRACE_BACKUPS) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        # the handler serializes writes from several threads and handles rotation
+        self.logger = logging.getLogger(f"natlagram.trace.{path.resolve()}")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+
+    def write(self, record: Dict) -> None:
+        """append a record to the log"""
+        self.logger.info(json.dumps(record))
+
+def build_record(prompt: str, mode: str, model: str, temperature: float, n: int, candidates: List[Dict],
+    timings: Dict[str, float], prompt_tokens: int, completion_tokens: int, memory: Dict[str, int] | None = None) -> Dict:
+    """build the trace record of a request
+
+    args:
+        prompt: the user prompt
+        mode: the interaction mode, e.g. "STATELESS"
+        model: the name of the model
+        temperature: the temperature the candidates were sampled with
+        n: the number of candidates requested
+        candidates: one dictionary per candidate with its "api", "code" and "valid"
+        timings: the seconds spent per stage, see metrics.collect_timings
+        prompt_tokens: the number of tokens of the request's messages
+        completion_tokens: the number of tokens of all candidates
+        memory: the memory high-water marks of the request, see metrics.track_memory
+
+    returns:
+        the record
+    """
+    return {
+        "time": time.time(),
+        "prompt": prompt,
+        "mode": mode,
+        "model": model,
+        "temperature": temperature,
+        "n": n,
+        "candidates": candidates,
+        "timings": timings,
+        "tokens": {"prompt": prompt_tokens, "completion": completion_tokens},
+        "memory": memory or {},
+    }
+
+def read_traces(path: Path) -> List[Dict]:
+    """read the records of a trace, oldest first
+
+    args:
+        path: the path of a trace log file
+    """
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return sorted(records, key=lambda record: record["time"])
@@ -0,0 +1,151 @@
+"""here lives a cheap local router that predicts the diagram API family of a prompt, to send a slimmer primer"""
+
+from collections import Counter
+import math
+from pathlib import Path
+import re
+from typing import Dict, List, Tuple
+
+from chatGPT import AbstractModel
+import const
+import data_io
+
+TRAINING_DATA = Path("resources/full_problems_and_labels.txt")
+
+# APIs that share syntax or diagram types are routed together
+API_FAMILIES = {
+"blockdiag": ["blockdiag", "seqdiag", "actdiag", "nwdiag", "packetdiag", "rackdiag"],
+"plantuml": ["plantuml", "c4plantuml", "structurizr"],
+"graphviz": ["dot", "graphviz", "d2"],
+"vega": ["vega", "vegalite"],
+"mermaid": ["mermaid"],
+"database": ["erd", "dbml"],
+"bpmn": ["bpmn"],
+"ascii": ["ditaa", "svgbob", "pikchr"],
+"nomnoml": ["nomnoml", "umlet"],
+"wavedrom": ["wavedrom", "bytefield"],
+"drawing": ["excalidraw", "diagramsnet"],
+}
+FAMILY_OF_API = {api: family for family, apis in API_FAMILIES.items() for api in apis}
+
+# keywords that hint at a family, used as extra training documents since the labelled examples are few
+FAMILY_KEYWORDS = {
+"blockdiag": ["sequence", "message", "actor", "activity", "network", "packet", "rack", "server", "block"],
+"plantuml": ["state", "machine", "class", "use case", "component", "deployment", "uml", "context", "container"],
+"graphviz": ["graph", "tree", "node", "edge", "hierarchy", "relation", "dependency"],
+"vega": ["plot", "chart", "axis", "bar", "line", "scatter", "histogram", "data", "velocity", "values"],
+"mermaid": ["pie", "gantt", "timeline", "journey", "flowchart", "git", "mindmap", "percentage", "schedule"],
+"database": ["database", "table", "entity", "schema", "column", "foreign", "key", "sql"],
+"bpmn": ["bpmn", "business", "process", "workflow", "task", "gateway"],
+"ascii": ["ascii", "art", "box", "sketch"],
+"nomnoml": ["logic", "implies", "proposition", "premise", "conclusion"],
+"wavedrom": ["signal", "wave", "clock", "timing", "bit", "byte", "field", "register"],
+"drawing": ["drawing", "draw", "whiteboard", "freehand"],
+}
+
+KEYWORD_WEIGHT = 3 # a keyword counts as often as this many occurrences in a labelled example
+
+WORD = re.compile(r"[a-z][a-z0-9]+")
+STOP_WORDS = {"the", "an", "to", "is", "are", "and", "or", "not", "no", "if", "then", "of", "in", "on", "for", "with",
+    "has", "have", "it", "its", "be", "by", "as", "at", "this", "that", "from", "make", "show", "me", "my", "we", "you",
+    "all", "what", "how", "like", "do", "does", "can", "should", "would", "diagram"}
+
+def tokenize(text: str) -> List[str]:
+    """split a prompt into lowercase words, without stop words, single letters and numbers"""
+    return [word for word in WORD.findall(text.lower()) if word not in STOP_WORDS]
+
+class ApiRouter:
+    """multinomial naive Bayes classifier over the words of a prompt, predicting an API family"""
+
+    def __init__(self) -> None:
+        self.family_counts: Counter = Counter() # number of training documents per family
+        self.word_counts: Dict[str, Counter] = {family: Counter() for family in API_FAMILIES}
+        self.vocabulary: set = set()
+
+    def add_document(self, text: str, family: str, weight: int = 1) -> None:
+        """add a labelled training document
+
+        args:
+            text: the prompt
+            family: the API family that the prompt was answered with
+            weight: the number of times each word of the document is counted
+        """
+        words = tokenize(text)
+        self.family_counts[family] += 1
+        for word in words:
+            self.word_counts[family][word] += weight
+        self.vocabulary.update(words)
+
+    @classmethod
+    def train(cls, problem_file: Path = TRAINING_DATA) -> "ApiRouter":
+        """train a router on a labelled problems file and the family keywords
+
+        args:
+            problem_file: a file in the format of data_io.load_problems_and_labels
+        """
+        router = cls()
+        parser = AbstractModel()
+        for problem, label in zip(*data_io.load_problems_and_labels(problem_file)):
+            api = parser.extract_diagram_api_from_response(label)
+            if api in FAMILY_OF_API:
+                router.add_document(problem, FAMILY_OF_API[api])
+        for family, keywords in FAMILY_KEYWORDS.items():
+            router.add_document(" ".join(keywords), family, KEYWORD_WEIGHT)
+        return router
+
+    def predict(self, prompt: str) -> Tuple[str, float]:
+        """predict the API family of a prompt
+
+        args:
+            prompt: the user prompt
+
+        returns:
+            a tuple with the most likely family and its posterior probability, 0 if the prompt has fewer known
+            words than const.ROUTER_MIN_WORDS, since the prior alone would decide
+        """
+        words = [word for word in tokenize(prompt) if word in self.vocabulary]
+        total_documents = sum(self.family_counts.values())
+        log_posteriors = {}
+        for family in API_FAMILIES:
+            counts = self.word_counts[family]
+            total_words = sum(counts.values())
+            log_p = math.log((self.family_counts[family] + 1) / (total_documents + len(API_FAMILIES)))
+            for word in words:
+                log_p += math.log((counts[word] + 1) / (total_words + len(self.vocabulary)))
+            log_posteriors[family] = log_p
+        best = max(log_posteriors, key=log_posteriors.get)
+        if len(words) < const.ROUTER_MIN_WORDS:
+            return best, 0.0
+        normalizer = sum(math.exp(log_p - log_posteriors[best]) for log_p in log_posteriors.values())
+        return best, 1 / normalizer
+
+def slim_primer_messages(primers: List[Dict[str, str]], family: str) -> List[Dict[str, str]]:
+    """return the primer messages with only the family's APIs listed as supported
+
+    args:
+        primers: the primer messages, e.g. from a primer bundle
+        family: the API family to keep
+    """
+    keep = set(API_FAMILIES[family])
+    def keep_line(line: str) -> bool:
+        # drop "api,version" rows of other APIs from the list of supported APIs
+        api = line.split(",")[0]
+        return api not in const.SERVICES or api in keep
+    slim = []
+    for message in primers:
+        content = "\n".join(line for line in message["content"].split("\n") if keep_line(line))
+        slim.append({"role": message["role"], "content": content})
+    return slim
+
+def route_bundle_messages(bundle: Dict, family: str) -> List[Dict[str, str]]:
+    """return the messages of a primer bundle specialized to an API family
+
+    args:
+        bundle: a bundle, see primer_bundle.load_bundle
+        family: the API family to keep
+    """
+    messages = slim_primer_messages(bundle["primers"], family)
+    for example in bundle["examples"]:
+        if FAMILY_OF_API.get(example["api"]) == family:
+            messages.extend(example["messages"])
+    return messages
@@ -0,0 +1,141 @@
+"""here lives adaptive sampling: persisted validity statistics and a policy choosing the number of candidates and the temperature"""
+
+import json
+import math
+from pathlib import Path
+import threading
+from typing import Dict, List, Tuple
+
+import const
+import data_io
+
+class ValidityStats:
+    """validity rate, latency and completion tokens per prompt category, diagram API and temperature, persisted as JSON
+
+    args:
+        path: the file the statistics are persisted in
+    """
+
+    def __init__(self, path: Path = Path(const.SAMPLING_STATS_FILE)) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, float]] = {}
+        if path.exists():
+            self.entries = json.loads(path.read_text())
+
+    def key(self, category: str, api: str, temperature: float) -> str:
+        """return the key of an entry, temperatures are rounded to one decimal"""
+        return f"{category}|{api}|{temperature:.1f}"
+
+    def record(self, category: str, api: str, temperature: float, valid: bool, latency: float, completion_tokens: int) -> None:
+        """record the outcome of one candidate and persist the statistics
+
+        args:
+            category: the category of the prompt, e.g. the API family predicted by the router
+            api: the diagram API of the candidate, empty if none could be extracted
+            temperature: the temperature the candidate was sampled with
+            valid: whether the candidate rendered
+            latency: the latency of the request that generated the candidate in seconds
+            completion_tokens: the number of tokens of the candidate
+        """
+        with self.lock:
+            entry = self.entries.setdefault(self.key(category, api, temperature),
+                {"attempts": 0, "valid": 0, "latency": 0.0, "completion_tokens": 0})
+            entry["attempts"] += 1
+            entry["valid"] += int(valid)
+            entry["latency"] += latency
+            entry["completion_tokens"] += completion_tokens
+            self.save()
+
+    def save(self) -> None:
+        """atomically write the statistics, call with the lock held"""
+        with data_io.atomic_path(self.path) as temp_path:
+            temp_path.write_text(json.dumps(self.entries, indent=1, sort_keys=True))
+
+    def aggregate(self, category: str | None, temperature: float | None) -> Dict[str, float]:
+        """sum the statistics over all APIs, and optionally over all categories and temperatures
+
+        args:
+            category: the category to aggregate, None for all categories
+            temperature: the temperature to aggregate, None for all temperatures
+        """
+        total = {"attempts": 0, "valid": 0, "latency": 0.0, "completion_tokens": 0}
+        with self.lock:
+            for key, entry in self.entries.items():
+                entry_category, _, entry_temperature = key.split("|")
+                if category is not None and entry_category != category:
+                    continue
+                if temperature is not None and entry_temperature != f"{temperature:.1f}":
+                    continue
+                for field in total:
+                    total[field] += entry[field]
+        return total
+
+class SamplingPolicy:
+    """choose the number of candidates and the temperature of a request to reach a target success probability at minimum token cost
+
+    The validity rate of a (category, temperature) pair is estimated with a Beta prior centered on the overall
+    validity rate, so that rarely seen pairs borrow strength from all observations.
+
+    args:
+        stats: the validity statistics
+        temperatures: the temperatures to choose from
+        target: the probability that at least one candidate is valid
+        max_n: the maximum number of candidates per request
+        prior_strength: the number of pseudo-observations of the prior
+        min_attempts: the number of recorded candidates below which the model's defaults are kept
+    """
+
+    def __init__(self,
+        stats: ValidityStats,
+        temperatures: List[float] = const.SAMPLING_TEMPERATURES,
+        target: float = const.SAMPLING_TARGET,
+        max_n: int = const.SAMPLING_MAX_N,
+        prior_strength: float = 4,
+        min_attempts: int = const.SAMPLING_MIN_ATTEMPTS,
+        ):
+        self.stats = stats
+        self.temperatures = temperatures
+        self.target = target
+        self.max_n = max_n
+        self.prior_strength = prior_strength
+        self.min_attempts = min_attempts
+
+    def candidates_needed(self, p: float, max_n: int) -> int:
+        """return the smallest number of candidates such that at least one is valid with the target probability, at most max_n"""
+        if p >= self.target:
+            return 1
+        if p <= 0:
+            return max_n
+        return min(max_n, math.ceil(math.log(1 - self.target) / math.log(1 - p)))
+
+    def choose(self, category: str, prompt_tokens: int, max_n: int | None = None) -> Tuple[int, float] | None:
+        """choose the number of candidates and the temperature for a request
+
+        args:
+            category: the category of the prompt
+            prompt_tokens: the number of tokens of the request's messages, paid once per request
+            max_n: the maximum number of candidates of this request, None for the policy's maximum
+
+        returns:
+            a tuple with the number of candidates and the temperature, None if there are too few statistics yet
+        """
+        max_n = self.max_n if max_n is None else max_n
+        overall = self.stats.aggregate(None, None)
+        if overall["attempts"] < max(1, self.min_attempts):
+            return None
+        prior_p = (overall["valid"] + 1) / (overall["attempts"] + 2)
+        prior_tokens = overall["completion_tokens"] / overall["attempts"]
+
+        best = None
+        for temperature in self.temperatures:
+            observed = self.stats.aggregate(category, temperature)
+            p = (observed["valid"] + self.prior_strength * prior_p) / (observed["attempts"] + self.prior_strength)
+            tokens_per_candidate = (observed["completion_tokens"] + self.prior_strength * prior_tokens) / (observed["attempts"] + self.prior_strength)
+            n = self.candidates_needed(p, max_n)
+            success = 1 - (1 - p) ** n
+            # requests that miss the target are retried, so the expected cost is the cost per request divided by its success
+            cost = (prompt_tokens + n * tokens_per_candidate) / max(success, 1e-6)
+            if best is None or cost < best[0]:
+                best = (cost, n, temperature)
+        return best[1], best[2]
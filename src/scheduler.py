@@ -0,0 +1,163 @@
+"""here lives a scheduler that admits requests to the openai API under requests-per-minute and tokens-per-minute budgets"""
+
+from collections import deque
+from enum import IntEnum
+import heapq
+import itertools
+import random
+import threading
+import time
+from typing import Any, Callable, Deque, List, Tuple
+
+import const
+import metrics
+
+class Priority(IntEnum):
+    """priority of a request, lower values are admitted first
+
+    INTERACTIVE: a user is waiting for the response, e.g. in the REPL
+    BATCH: nobody is waiting, e.g. replaying or generating many diagrams
+    """
+    INTERACTIVE = 0
+    BATCH = 1
+
+class RequestError(Exception):
+    """a request to the openai API failed, e.g. it was rejected or the request process died"""
+
+class RetryableError(RequestError):
+    """a request failed with a transient error (429 or 5xx) and may be retried
+
+    args:
+        message: a description of the error
+        retry_after: the number of seconds the server asked us to wait, if any
+    """
+
+    def __init__(self, message: str, retry_after: float | None = None) -> None:
+        # pass all arguments to Exception so that the error survives pickling across processes
+        super().__init__(message, retry_after)
+        self.message = message
+        self.retry_after = retry_after
+
+    def __str__(self) -> str:
+        return self.message
+
+class RequestScheduler:
+    """admit requests under RPM/TPM budgets, in order of priority, and retry transient errors with jittered backoff"""
+
+    def __init__(self,
+        requests_per_minute: int = const.OPENAI_RPM,
+        tokens_per_minute: int = const.OPENAI_TPM,
+        max_retries: int = const.OPENAI_MAX_RETRIES,
+        backoff_base: float = 1, # seconds
+        backoff_max: float = 30, # seconds
+        ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.window: Deque[Tuple[float, int]] = deque() # (admission time, tokens) of requests in the last minute
+        self.waiting: List[Tuple[int, int]] = [] # heap of (priority, ticket) of requests waiting for admission
+        self.tickets = itertools.count()
+        self.condition = threading.Condition()
+
+    def expire_window(self, now: float) -> None:
+        """forget admissions that are older than one minute"""
+        while self.window and now - self.window[0][0] >= 60:
+            self.window.popleft()
+
+    def time_until_admissible(self, tokens: int, now: float) -> float:
+        """return how long a request with the given number of tokens has to wait for budget, 0 if it fits now"""
+        self.expire_window(now)
+        if not self.window:
+            return 0 # always admit a single request, even if it exceeds the token budget on its own
+        used_tokens = sum(t for _, t in self.window)
+        if len(self.window) < self.requests_per_minute and used_tokens + tokens <= self.tokens_per_minute:
+            return 0
+        # wait until enough of the oldest admissions have expired
+        freed_tokens = 0
+        for i, (admitted, t) in enumerate(self.window):
+            freed_tokens += t
+            enough_requests = len(self.window) - (i + 1) < self.requests_per_minute
+            enough_tokens = used_tokens - freed_tokens + tokens <= self.tokens_per_minute
+            if enough_requests and enough_tokens:
+                return admitted + 60 - now
+        return self.window[-1][0] + 60 - now
+
+    def acquire(self, tokens: int, priority: Priority = Priority.INTERACTIVE) -> None:
+        """block until a request is admitted under the budgets
+
+        args:
+            tokens: the estimated number of tokens of the request
+            priority: the priority of the request
+        """
+        with self.condition:
+            ticket = (int(priority), next(self.tickets))
+            enqueued = time.time()
+            heapq.heappush(self.waiting, ticket)
+            while True:
+                now = time.time()
+                if self.waiting[0] == ticket:
+                    delay = self.time_until_admissible(tokens, now)
+                    if delay <= 0:
+                        metrics.observe("natlagram_admission_wait_seconds", now - enqueued, priority=priority.name.lower())
+                        heapq.heappop(self.waiting)
+                        self.window.append((now, tokens))
+                        self.condition.notify_all()
+                        return
+                    self.condition.wait(timeout=delay)
+                else:
+                    self.condition.wait()
+
+    def try_acquire(self, tokens: int) -> bool:
+        """admit a request only if it fits the budgets now and nobody is waiting, without blocking
+
+        args:
+            tokens: the estimated number of tokens of the request
+
+        returns:
+            True if the request was admitted, False otherwise
+        """
+        with self.condition:
+            now = time.time()
+            if self.waiting or self.time_until_admissible(tokens, now) > 0:
+                return False
+            self.window.append((now, tokens))
+            return True
+
+    def backoff(self, attempt: int, retry_after: float | None) -> float:
+        """return the number of seconds to wait before retrying
+
+        args:
+            attempt: the number of the failed attempt, starting at 0
+            retry_after: the number of seconds the server asked us to wait, if any
+        """
+        # full jitter avoids retrying in lockstep with other clients
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def run(self, request: Callable[[], Any], tokens: int, priority: Priority = Priority.INTERACTIVE) -> Any:
+        """run a request once it is admitted, retrying transient errors
+
+        args:
+            request: a function that performs the request and raises RetryableError on transient errors
+            tokens: the estimated number of tokens of the request
+            priority: the priority of the request
+
+        returns:
+            the return value of the request
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens, priority)
+            try:
+                return request()
+            except RetryableError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt, e.retry_after)
+                metrics.inc("natlagram_retries_total", kind="openai")
+                print(f"OpenAI request failed ({e}), retrying in {delay:.1f} seconds")
+                time.sleep(delay)
@@ -0,0 +1,125 @@
+"""here lives persistence of REPL sessions, so that conversations survive crashes and restarts
+
+A session is stored as a small gzipped JSON file holding only what differs from the shared primer bundle:
+a reference to the bundle, the interaction mode, the API family the primer was specialized to and the
+messages after the primer. Sessions are only read when resumed, so idle sessions cost disk space, not RAM.
+"""
+
+import gzip
+import json
+from pathlib import Path
+import time
+from typing import Dict, List
+
+from chatGPT_official import InteractionMode, Model
+import const
+import data_io
+
+SESSION_VERSION = 1 # increment when the session format changes
+
+def split_messages(model: Model, messages: List[Dict[str, str]], route: str | None) -> Dict:
+    """split messages into a reference to the primer they start with and the messages after it
+
+    args:
+        model: the model whose primer bundle the messages start with
+        messages: the messages to split
+        route: the API family the primer was specialized to, None for the full primer
+
+    returns:
+        a dictionary with the route and the tail, or the full messages if they don't start with the primer
+    """
+    prefix = model.primer_messages(route)
+    if prefix is not None and messages[:len(prefix)] == prefix:
+        tail = messages[len(prefix):]
+        return {"route": route, "tail": [{"role": m["role"], "content": m["content"]} for m in tail]}
+    return {"route": route, "messages": [{"role": m["role"], "content": m["content"]} for m in messages]}
+
+def join_messages(model: Model, split: Dict) -> List[Dict[str, str]]:
+    """rebuild messages split by split_messages
+
+    args:
+        model: the model whose primer bundle the messages start with
+        split: the output of split_messages
+    """
+    if "messages" in split:
+        return split["messages"]
+    return model.primer_messages(split["route"]) + split["tail"]
+
+class SessionStore:
+    """save and restore sessions as files in a directory
+
+    args:
+        root: the directory sessions are stored in
+    """
+
+    def __init__(self, root: Path = Path(const.SESSION_DIR)) -> None:
+        self.root = root
+
+    def path(self, session_id: str) -> Path:
+        """return the path of a session's file"""
+        if not session_id or Path(session_id).name != session_id:
+            raise ValueError(f"Invalid session id {session_id!r}.")
+        return self.root / f"{session_id}.json.gz"
+
+    def exists(self, session_id: str) -> bool:
+        """return whether a session has been saved"""
+        return self.path(session_id).exists()
+
+    def list_sessions(self) -> List[str]:
+        """return the ids of all stored sessions, without loading them"""
+        return sorted(path.name[:-len(".json.gz")] for path in self.root.glob("*.json.gz"))
+
+    def save(self, session_id: str, model: Model) -> None:
+        """atomically save a model's conversation
+
+        args:
+            session_id: the id of the session
+            model: the model whose conversation is saved
+        """
+        session = {
+            "version": SESSION_VERSION,
+            "updated": time.time(),
+            "bundle": model.bundle["source_hash"] if model.bundle is not None else None,
+            "interaction_mode": model.interaction_mode.name,
+            "messages": split_messages(model, model.messages, model.route),
+            "backup": split_messages(model, model.messages_backup, model.route_backup) if model.messages_backup is not None else None,
+        }
+        with data_io.atomic_path(self.path(session_id)) as temp_path, gzip.open(temp_path, "wt", encoding="utf-8") as f:
+            json.dump(session, f, separators=(",", ":"))
+
+    def restore(self, session_id: str, model: Model) -> None:
+        """restore a saved conversation into a model that has been primed with the same bundle
+
+        The model is only modified once the session has been read completely. A ValueError is raised if the
+        session is corrupt or was saved with another version or primer bundle.
+
+        args:
+            session_id: the id of the session
+            model: the model to restore the conversation into
+        """
+        try:
+            with gzip.open(self.path(session_id), "rt", encoding="utf-8") as f:
+                session = json.load(f)
+            if session["version"] != SESSION_VERSION:
+                raise ValueError(f"Session {session_id} has version {session['version']}, expected {SESSION_VERSION}.")
+            bundle_hash = model.bundle["source_hash"] if model.bundle is not None else None
+            if session["bundle"] != bundle_hash:
+                raise ValueError(f"Session {session_id} was saved with a different primer bundle.")
+            interaction_mode = InteractionMode[session["interaction_mode"]]
+            messages = join_messages(model, session["messages"])
+            route = session["messages"]["route"]
+            backup = join_messages(model, session["backup"]) if session["backup"] is not None else None
+            route_backup = session["backup"]["route"] if session["backup"] is not None else None
+        except (OSError, EOFError, KeyError, TypeError) as e: # e.g. a truncated or corrupt file
+            raise ValueError(f"Session {session_id} is corrupt: {e!r}") from e
+
+        model.set_interaction_mode(interaction_mode)
+        model.messages = messages
+        model.route = route
+        if backup is not None:
+            model.messages_backup = backup
+            model.route_backup = route_backup
+
+    def delete(self, session_id: str) -> None:
+        """delete a session"""
+        self.path(session_id).unlink(missing_ok=True)
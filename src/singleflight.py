@@ -0,0 +1,57 @@
+"""here lives single-flight coalescing: concurrent calls with the same key are performed once and share the result"""
+
+import threading
+from typing import Any, Callable, Dict, Hashable
+
+class Flight:
+    """a call in progress, waited on by every caller with the same key"""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+class SingleFlight:
+    """coalesce concurrent identical work
+
+    Unlike a cache, nothing is kept once a call completes: a call that starts after another one
+    with the same key has finished is performed again.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.flights: Dict[Hashable, Flight] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """call fn, unless a call with the same key is already in flight, then wait for and return its result
+
+        args:
+            key: identifies equivalent calls
+            fn: the function to call
+
+        returns:
+            the return value of fn, possibly from another caller's call. Exceptions are shared as well.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
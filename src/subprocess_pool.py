@@ -0,0 +1,77 @@
+"""here lives a pool of warm subprocesses, started ahead of time so that a request doesn't pay for process startup"""
+
+import queue
+import subprocess
+import threading
+from typing import List, Tuple
+
+class SubprocessPool:
+    """keep idle processes of a command waiting on stdin
+
+    Each process handles exactly one request: its input is written to stdin, stdin is closed and the output
+    is read until the process exits. A replacement is started in the background right away.
+
+    args:
+        command: the command to run, e.g. ["dot", "-Tsvg"]
+        size: the number of idle processes to keep
+    """
+
+    def __init__(self, command: List[str], size: int = 2) -> None:
+        self.command = command
+        self.size = size
+        self.idle: queue.Queue = queue.Queue()
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def spawn(self) -> subprocess.Popen:
+        """start an idle process"""
+        return subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def replenish(self) -> None:
+        """start an idle process in the background, unless the pool is full or closed"""
+        def start() -> None:
+            with self.lock:
+                if self.closed or self.idle.qsize() >= self.size:
+                    return
+                self.idle.put(self.spawn())
+        threading.Thread(target=start, daemon=True).start()
+
+    def warm_up(self) -> None:
+        """start idle processes until the pool is full"""
+        with self.lock:
+            while not self.closed and self.idle.qsize() < self.size:
+                self.idle.put(self.spawn())
+
+    def run(self, data: bytes, timeout: float) -> Tuple[int, bytes, bytes]:
+        """run one request on an idle process, or on a new one if none is idle
+
+        args:
+            data: the input written to the process' stdin
+            timeout: the number of seconds after which the process is killed
+
+        returns:
+            a tuple with the return code, stdout and stderr of the process
+        """
+        try:
+            process = self.idle.get_nowait()
+        except queue.Empty:
+            process = self.spawn()
+        self.replenish()
+        if process.poll() is not None: # an idle process died, e.g. it was killed
+            process = self.spawn()
+        try:
+            stdout, stderr = process.communicate(data, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise
+        return process.returncode, stdout, stderr
+
+    def close(self) -> None:
+        """terminate all idle processes"""
+        with self.lock:
+            self.closed = True
+            while not self.idle.empty():
+                process = self.idle.get_nowait()
+                process.kill()
+                process.wait()
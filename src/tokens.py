@@ -0,0 +1,38 @@
+"""here lives token counting for chat messages, shared by the model and the primer bundle"""
+
+from functools import lru_cache
+from typing import Dict
+
+import tiktoken
+
+REPLY_TOKENS = 2 # every reply is primed with <im_start>assistant
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """return the encoding of a model, loaded once per process
+
+    args:
+        model: the name of the model, e.g. "gpt-3.5-turbo"
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def count_message_tokens(message: Dict[str, str], model: str) -> int:
+    """return the number of tokens a single message uses
+
+    args:
+        message: the message, e.g. {"role": "user", "content": "A->B"}
+        model: the name of the model, e.g. "gpt-3.5-turbo"
+    """
+    if model not in ["gpt-3.5-turbo"]: # NOTE: future models may deviate from this
+        raise NotImplementedError(f"""count_message_tokens() is not presently implemented for model {model}.
+        See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
+    encoding = get_encoding(model)
+    num_tokens = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":  # if there's a name, the role is omitted
+            num_tokens += -1  # role is always required and always 1 token
+    return num_tokens
@@ -0,0 +1,33 @@
+"""here lives the pytest setup: the modules in src/ import each other by name, so src/ goes on the path
+
+secret.py holds the user's openai key and is not part of the repo. The openai client, tiktoken and the cairo- and
+pango-based converters are stubbed where they can't be imported, since the tests fake the model and the renderers.
+"""
+
+import importlib
+from pathlib import Path
+import sys
+import types
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+# module name -> attributes that are needed at import time of the modules under test
+STUBS = {
+"secret": {"OPENAI_API_KEY": ""},
+"openai": {},
+"tiktoken": {"Encoding": object},
+"cairosvg": {},
+"weasyprint": {},
+"pdfkit": {},
+}
+
+STUBBED = set() # the names of the stubbed modules, tests that need the real module skip if it is stubbed
+
+for name, attributes in STUBS.items():
+    try:
+        importlib.import_module(name)
+    except (ImportError, OSError): # cairosvg and weasyprint raise OSError without the cairo and pango libraries
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+        STUBBED.add(name)
@@ -0,0 +1,41 @@
+"""here live tests of the canonicalization that recognizes equivalent candidates"""
+
+from canonical import canonicalize, group_candidates, strip_inline_comment
+
+def test_whitespace_and_comments_are_insignificant():
+    a = "digraph {\n  a -> b; // edge\n}\n"
+    b = "// a graph\ndigraph {\n\n/* block\ncomment */  a -> b;\n}   "
+    assert canonicalize("dot", a) == canonicalize("dot", b)
+
+def test_code_after_stop_marker_is_ignored():
+    assert canonicalize("dot", "a -> b\nCODE_BLOCK_STOP trailing text") == canonicalize("dot", "a -> b")
+
+def test_different_code_stays_different():
+    assert canonicalize("dot", "a -> b") != canonicalize("dot", "a -> c")
+
+def test_comment_prefixes_inside_strings_are_kept():
+    assert strip_inline_comment('a [label="http://x"] // c', ("//",)) == 'a [label="http://x"] '
+    assert strip_inline_comment(r'a [label="say \"//\""]', ("//",)) == r'a [label="say \"//\""]'
+
+def test_colors_are_not_line_comments():
+    assert canonicalize("d2", "a: {style.fill: \"#FF0000\"}") != canonicalize("d2", "a: {style.fill: \"#00FF00\"}")
+
+def test_indentation_is_kept_where_it_matters():
+    assert canonicalize("ditaa", "+--+\n|  |\n") != canonicalize("ditaa", "  +--+\n  |  |\n")
+    assert canonicalize("ditaa", "+--+   \n") == canonicalize("ditaa", "+--+")
+
+def test_json_is_compared_after_parsing():
+    assert canonicalize("vegalite", '{"a": 1, "b": [1, 2]}') == canonicalize("vegalite", '{ "b":[1,2],\n "a":1 }')
+
+def test_invalid_json_is_compared_as_text():
+    assert canonicalize("vegalite", "{invalid") == "{invalid"
+
+def test_group_candidates_in_order():
+    candidates = [("dot", "a -> b"), ("mermaid", "a --> b"), ("dot", " a -> b // same"), ("dot", "a -> c")]
+    assert group_candidates(candidates) == [[0, 2], [1], [3]]
+
+def test_same_code_of_different_apis_is_not_grouped():
+    assert group_candidates([("dot", "a -> b"), ("graphviz", "a -> b")]) == [[0], [1]]
+
+def test_failed_extractions_are_not_grouped():
+    assert group_candidates([("", ""), ("", ""), ("dot", ""), ("dot", "")]) == [[0], [1], [2], [3]]
@@ -0,0 +1,48 @@
+"""here live tests of atomic writes and the content-addressed output store"""
+
+import pytest
+
+import data_io
+from data_io import OutputStore, atomic_path
+
+def test_atomic_path_replaces_the_file_on_success(tmp_path):
+    path = tmp_path / "dir" / "file.json"
+    with atomic_path(path) as temp_path:
+        temp_path.write_text("new")
+        assert not path.exists()
+    assert path.read_text() == "new"
+    assert [p.name for p in path.parent.iterdir()] == ["file.json"]
+
+def test_atomic_path_keeps_the_old_file_on_failure(tmp_path):
+    path = tmp_path / "file.json"
+    path.write_text("old")
+    with pytest.raises(RuntimeError):
+        with atomic_path(path) as temp_path:
+            temp_path.write_text("partial")
+            raise RuntimeError("interrupted")
+    assert path.read_text() == "old"
+    assert [p.name for p in tmp_path.iterdir()] == ["file.json"]
+
+def test_keys_depend_on_api_and_code(tmp_path):
+    store = OutputStore(tmp_path)
+    assert store.key("dot", "a -> b") == store.key("dot", "a -> b")
+    assert len({store.key("dot", "a -> b"), store.key("graphviz", "a -> b"), store.key("dot", "a -> c")}) == 3
+
+def test_artifacts_are_sharded_and_indexed(tmp_path):
+    store = OutputStore(tmp_path, shard_length=2)
+    key = store.key("dot", "a -> b")
+    svg = store.path(key, "dot", ".svg")
+    assert svg == tmp_path / key[:2] / f"dot_{key}.svg"
+    store.write_bytes(svg, b"<svg/>")
+    store.add_to_index("prompt", "dot", key, {"svg": svg})
+    store.add_to_index("other prompt", "dot", key, {"svg": svg})
+    assert svg.read_bytes() == b"<svg/>"
+    [record] = store.lookup("prompt")
+    assert record["key"] == key and record["artifacts"] == {"svg": f"{key[:2]}/dot_{key}.svg"}
+    assert store.lookup("unknown") == []
+
+def test_problems_and_labels_are_paired(tmp_path):
+    problems = tmp_path / "problems.txt"
+    problems.write_text("# comment\n---PROBLEM\nA is B.\nCODE_BLOCK_START\nblockdiag {\n}\nCODE_BLOCK_STOP\nDIAGRAM_API=blockdiag\n")
+    assert data_io.load_problems_and_labels(problems) == (["A is B.\n"],
+        ["CODE_BLOCK_START\nblockdiag {\n}\nCODE_BLOCK_STOP\nDIAGRAM_API=blockdiag\n"])
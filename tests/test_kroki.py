@@ -0,0 +1,47 @@
+"""here live tests of the rendering helpers that don't need a kroki server"""
+
+import threading
+
+import pytest
+import requests
+
+import kroki
+
+def test_services_are_ready_independently(monkeypatch):
+    release = threading.Event()
+
+    def warm_up_service(service, server_url):
+        if service == "bpmn":
+            release.wait()
+        if service == "broken":
+            raise requests.RequestException("no container")
+        return 1.0, 0.1
+
+    monkeypatch.setattr(kroki, "warm_up_service", warm_up_service)
+    ready = {service: threading.Event() for service in ["dot", "bpmn", "broken"]}
+    latencies = {}
+    thread = threading.Thread(target=lambda: latencies.update(kroki.warm_up_services(list(ready), ready=ready)))
+    thread.start()
+    assert ready["dot"].wait(timeout=5) and ready["broken"].wait(timeout=5)
+    assert not ready["bpmn"].is_set()
+    release.set()
+    thread.join(timeout=5)
+    assert ready["bpmn"].is_set()
+    assert latencies == {"dot": (1.0, 0.1), "bpmn": (1.0, 0.1)}
+
+SVG = b'<svg xmlns="http://www.w3.org/2000/svg" width="200px" height="100px"><rect width="150" height="50"/></svg>'
+
+requires_cairo = pytest.mark.skipif(not hasattr(kroki.cairosvg, "svg2png"), reason="needs cairosvg and the cairo library")
+
+@requires_cairo
+def test_svg_is_printed_to_pdf():
+    assert kroki.print_svg_content(SVG).startswith(b"%PDF")
+
+def png_width(png: bytes) -> int:
+    return int.from_bytes(png[16:20], "big") # the width field of the IHDR chunk
+
+@requires_cairo
+@pytest.mark.parametrize("unit", ["px", "pt"])
+def test_preview_is_smaller_than_the_full_png(unit):
+    svg = SVG.replace(b"px", unit.encode())
+    assert png_width(kroki.convert_svg_content_to_preview(svg, scale=0.5)) < png_width(kroki.convert_svg_content_to_png(svg))
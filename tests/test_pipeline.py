@@ -0,0 +1,159 @@
+"""here live tests of how the pipeline resolves, deduplicates and fails requests, with a fake model and renderer"""
+
+from pathlib import Path
+import threading
+import time
+
+import pytest
+
+from chatGPT import AbstractModel
+import data_io
+import kroki
+from pipeline import Pipeline
+
+TIMEOUT = 10 # seconds
+
+def response(api: str, code: str) -> str:
+    return f"DIAGRAM_API={api}\nCODE_BLOCK_START\n{code}\nCODE_BLOCK_STOP"
+
+class FakeModel(AbstractModel):
+    """a model that returns fixed responses"""
+
+    def __init__(self, texts=None, error=None):
+        self.texts = texts or []
+        self.error = error
+
+    def estimate_tokens(self, prompt=None):
+        return 1
+
+    def generate_message(self, prompt, temperature=None, n=None):
+        if self.error is not None:
+            raise self.error
+        return self.texts
+
+@pytest.fixture
+def renders(monkeypatch):
+    """render code into a fake SVG, code containing "invalid" renders an error image and "broken" fails to convert"""
+    calls = []
+
+    def render_diagram(code, api, output_format):
+        calls.append(code)
+        return f"<svg>{code}</svg>".encode()
+
+    def convert(svg_content, dpi=300):
+        if b"broken" in svg_content:
+            raise RuntimeError("conversion failed")
+        return b"png"
+
+    monkeypatch.setattr(kroki, "render_diagram", render_diagram)
+    monkeypatch.setattr(kroki, "check_content_valid", lambda text, api, code: "invalid" not in code)
+    monkeypatch.setattr(kroki, "convert_svg_content_to_png", convert)
+    monkeypatch.setattr(kroki, "convert_svg_content_to_preview", convert)
+    monkeypatch.setattr(kroki, "print_svg_content", lambda svg_content: b"pdf")
+    return calls
+
+@pytest.fixture
+def make_pipeline(tmp_path):
+    pipelines = []
+
+    def make(models):
+        pipeline = Pipeline(models, data_io.OutputStore(tmp_path))
+        pipelines.append(pipeline)
+        return pipeline
+
+    yield make
+    for pipeline in pipelines:
+        pipeline.close()
+
+def test_candidates_are_validated_and_stored(renders, make_pipeline):
+    pipeline = make_pipeline([FakeModel([response("dot", "a -> b"), response("dot", "a -> invalid")])])
+    request = pipeline.submit("prompt")
+    valid, invalid = request.future.result(timeout=TIMEOUT)
+    assert (valid.valid, invalid.valid) == (True, False)
+    request.done.result(timeout=TIMEOUT)
+    assert valid.preview.result() == b"png"
+    assert set(valid.stored.result()) == {"svg", "preview", "pdf", "png"}
+    assert all(Path(path).exists() for path in valid.stored.result().values())
+    assert invalid.preview.result() is None and invalid.stored.result() == {}
+    assert {"llm", "extract", "render", "validate", "convert", "store"} <= set(request.timings_snapshot())
+
+def test_duplicates_are_rendered_once_and_share_results(renders, make_pipeline):
+    texts = [response("dot", "a -> b"), response("dot", "a -> b // same"), response("dot", "a -> c")]
+    pipeline = make_pipeline([FakeModel(texts)])
+    request = pipeline.submit("prompt")
+    first, duplicate, other = request.future.result(timeout=TIMEOUT)
+    assert duplicate.duplicate_of == 0 and first.duplicate_of is None and other.duplicate_of is None
+    assert len(renders) == 2
+    assert duplicate.valid and duplicate.svg_content == first.svg_content
+    request.done.result(timeout=TIMEOUT)
+    assert duplicate.stored.result() == first.stored.result()
+
+def test_failed_extractions_are_rejected_individually(renders, make_pipeline):
+    pipeline = make_pipeline([FakeModel(["no code", "no code either"])])
+    request = pipeline.submit("prompt")
+    candidates = request.future.result(timeout=TIMEOUT)
+    assert [candidate.duplicate_of for candidate in candidates] == [None, None]
+    assert not any(candidate.valid for candidate in candidates)
+    assert not renders
+    request.done.result(timeout=TIMEOUT)
+
+def test_model_errors_fail_the_request(renders, make_pipeline):
+    pipeline = make_pipeline([FakeModel(error=RuntimeError("model failed"))])
+    request = pipeline.submit("prompt")
+    with pytest.raises(RuntimeError, match="model failed"):
+        request.future.result(timeout=TIMEOUT)
+    with pytest.raises(RuntimeError, match="model failed"):
+        request.done.result(timeout=TIMEOUT)
+
+def test_conversion_errors_fail_only_the_stored_future(renders, make_pipeline):
+    pipeline = make_pipeline([FakeModel([response("dot", "a -> broken"), response("dot", "a -> b")])])
+    request = pipeline.submit("prompt")
+    broken, fine = request.future.result(timeout=TIMEOUT)
+    assert broken.valid and fine.valid
+    request.done.result(timeout=TIMEOUT)
+    assert broken.preview.result() is None
+    with pytest.raises(RuntimeError, match="conversion failed"):
+        broken.stored.result()
+    assert fine.stored.result()
+
+def test_requests_without_responses_resolve(renders, make_pipeline):
+    pipeline = make_pipeline([])
+    request = pipeline.submit_texts("prompt", [])
+    assert request.future.result(timeout=TIMEOUT) == []
+    assert request.done.result(timeout=TIMEOUT) == []
+
+def test_code_is_submitted_without_a_model(renders, make_pipeline):
+    pipeline = make_pipeline([])
+    request = pipeline.submit_code("prompt", [("dot", "a -> b"), ("", "")])
+    candidates = request.future.result(timeout=TIMEOUT)
+    assert [candidate.valid for candidate in candidates] == [True, False]
+    assert candidates[0].api == "dot" and candidates[0].code == "a -> b"
+
+def test_render_waits_only_for_its_api(renders, tmp_path):
+    ready = {"dot": threading.Event(), "bpmn": threading.Event()}
+    pipeline = Pipeline([], data_io.OutputStore(tmp_path), ready=ready)
+    request = pipeline.submit_code("prompt", [("dot", "a -> b")])
+    other = pipeline.submit_code("prompt", [("mermaid", "a --> b")])
+    assert other.future.result(timeout=TIMEOUT)[0].valid # mermaid has no event
+    assert not request.future.done() and renders == ["a --> b"]
+    ready["dot"].set()
+    assert request.future.result(timeout=TIMEOUT)[0].valid # bpmn is still warming up
+    pipeline.close()
+
+def test_render_time_is_counted_once(make_pipeline, monkeypatch):
+    class SlowRenderer(kroki.Renderer):
+        name = "slow"
+
+        def supports(self, diagram_api, output_format):
+            return True
+
+        def render(self, diagram, diagram_api, output_format):
+            time.sleep(0.2)
+            return b"<svg></svg>"
+
+    monkeypatch.setattr(kroki, "renderers", [SlowRenderer()])
+    monkeypatch.setattr(kroki, "check_content_valid", lambda text, api, code: False)
+    pipeline = make_pipeline([])
+    request = pipeline.submit_code("prompt", [("dot", "a -> b")])
+    request.done.result(timeout=TIMEOUT)
+    assert 0.2 <= request.timings_snapshot()["render"] < 0.35
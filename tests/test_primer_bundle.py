@@ -0,0 +1,50 @@
+"""here live tests of compiling, caching and invalidating the primer bundle"""
+
+import pytest
+
+import primer_bundle
+
+PROBLEMS = "---PROBLEM\nA is B.\nCODE_BLOCK_START\nblockdiag {\n  A -> B;\n}\nCODE_BLOCK_STOP\nDIAGRAM_API=blockdiag\n"
+
+@pytest.fixture(autouse=True)
+def count_characters(monkeypatch):
+    """count characters instead of tokens, so that no tokenizer has to be downloaded"""
+    monkeypatch.setattr(primer_bundle.tokens, "count_message_tokens", lambda message, model: len(message["content"]))
+
+@pytest.fixture
+def problem_file(tmp_path):
+    path = tmp_path / "problems.txt"
+    path.write_text(PROBLEMS)
+    return path
+
+def test_bundle_holds_primers_examples_and_token_counts(problem_file):
+    bundle = primer_bundle.compile_bundle(problem_file)
+    assert [example["api"] for example in bundle["examples"]] == ["blockdiag"]
+    assert bundle["examples"][0]["tokens"] == [len(message["content"]) for message in bundle["examples"][0]["messages"]]
+    assert len(bundle["primer_tokens"]) == len(bundle["primers"])
+    messages = primer_bundle.bundle_messages(bundle)
+    assert messages[:len(bundle["primers"])] == bundle["primers"] and messages[-1]["role"] == "assistant"
+
+def test_compact_bundle_has_a_single_system_message(problem_file):
+    [message] = primer_bundle.compile_bundle(problem_file, compact=True)["primers"]
+    assert message["role"] == "system" and "ACK" not in message["content"]
+
+def test_bundle_is_built_once_and_reused(problem_file, tmp_path, monkeypatch):
+    bundle = primer_bundle.load_bundle(problem_file=problem_file, directory=tmp_path)
+    assert primer_bundle.bundle_path(directory=tmp_path).exists()
+    monkeypatch.setattr(primer_bundle, "compile_bundle", lambda *args: pytest.fail("the bundle was rebuilt"))
+    assert primer_bundle.load_bundle(problem_file=problem_file, directory=tmp_path) == bundle
+
+def test_bundle_is_rebuilt_when_its_sources_change(problem_file, tmp_path, monkeypatch):
+    bundle = primer_bundle.load_bundle(problem_file=problem_file, directory=tmp_path)
+    problem_file.write_text(PROBLEMS + PROBLEMS.replace("A is B.", "B is C."))
+    rebuilt = primer_bundle.load_bundle(problem_file=problem_file, directory=tmp_path)
+    assert rebuilt["source_hash"] != bundle["source_hash"] and len(rebuilt["examples"]) == 2
+    monkeypatch.setattr(primer_bundle.bot_primer, "basic_primers", ["changed primer"])
+    assert primer_bundle.load_bundle(problem_file=problem_file, directory=tmp_path)["primers"][0]["content"] == "changed primer"
+
+def test_compact_and_full_bundles_are_stored_apart(problem_file, tmp_path):
+    full = primer_bundle.load_bundle(problem_file=problem_file, directory=tmp_path)
+    compact = primer_bundle.load_bundle(compact=True, problem_file=problem_file, directory=tmp_path)
+    assert full["source_hash"] != compact["source_hash"]
+    assert primer_bundle.load_bundle(problem_file=problem_file, directory=tmp_path) == full
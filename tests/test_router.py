@@ -0,0 +1,53 @@
+"""here live tests of the local router that specializes primers to an API family"""
+
+from pathlib import Path
+
+import pytest
+
+import const
+from router import API_FAMILIES, FAMILY_KEYWORDS, STOP_WORDS, ApiRouter, route_bundle_messages, slim_primer_messages, tokenize
+
+TRAINING_DATA = Path(__file__).resolve().parent.parent / "resources" / "full_problems_and_labels.txt"
+
+@pytest.fixture(scope="module")
+def router():
+    return ApiRouter.train(TRAINING_DATA)
+
+def test_tokenize_drops_stop_words_and_single_letters():
+    assert tokenize("Show me a Pie chart of A and B, or not") == ["pie", "chart"]
+
+def test_keywords_are_not_stop_words():
+    assert not [keyword for keywords in FAMILY_KEYWORDS.values() for keyword in keywords if keyword in STOP_WORDS]
+
+def test_everyday_questions_are_not_routed(router):
+    for prompt in ["Should I buy a car or not?", "If it rains, the street is wet", "hello"]:
+        assert router.predict(prompt)[1] < const.ROUTER_MIN_CONFIDENCE, prompt
+
+def test_too_few_known_words_are_not_trusted(router):
+    assert router.predict("a gantt")[1] == 0
+
+def test_clear_prompts_are_routed(router):
+    assert router.predict("a gantt schedule for a project")[0] == "mermaid"
+    assert router.predict("sequence of messages between a client and a server")[0] == "blockdiag"
+    family, confidence = router.predict("a gantt schedule for a project")
+    assert confidence >= const.ROUTER_MIN_CONFIDENCE
+
+def test_naive_bayes_prefers_the_family_of_its_words():
+    router = ApiRouter()
+    router.add_document("pie chart percentage", "mermaid")
+    router.add_document("signal clock wave", "wavedrom")
+    family, confidence = router.predict("clock signal")
+    assert family == "wavedrom" and 1 / len(API_FAMILIES) < confidence <= 1
+
+def test_slim_primer_keeps_only_the_family_apis():
+    primers = [{"role": "system", "content": "Supported APIs:\nmermaid,9\ndot,2\nvega,5\nCODE_BLOCK_START"}]
+    slim = slim_primer_messages(primers, "vega")
+    assert slim == [{"role": "system", "content": "Supported APIs:\nvega,5\nCODE_BLOCK_START"}]
+    assert primers[0]["content"].count("\n") == 4 # not modified
+
+def test_routed_bundle_adds_only_the_family_examples():
+    example = lambda api: {"api": api, "messages": [{"role": "user", "content": api}]}
+    bundle = {"primers": [{"role": "system", "content": "primer"}], "examples": [example("dot"), example("mermaid"), example("d2")]}
+    messages = route_bundle_messages(bundle, "graphviz")
+    assert [message["content"] for message in messages] == ["primer", "dot", "d2"]
+    assert set(API_FAMILIES["graphviz"]) >= {"dot", "d2"}
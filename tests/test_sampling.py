@@ -0,0 +1,62 @@
+"""here live tests of the validity statistics and the adaptive sampling policy"""
+
+import pytest
+
+from sampling import SamplingPolicy, ValidityStats
+
+@pytest.fixture
+def stats(tmp_path):
+    return ValidityStats(tmp_path / "stats" / "sampling_stats.json")
+
+def record(stats, category, temperature, valid, invalid, tokens=100):
+    for _ in range(valid):
+        stats.record(category, "dot", temperature, True, 1.0, tokens)
+    for _ in range(invalid):
+        stats.record(category, "dot", temperature, False, 1.0, tokens)
+
+def test_stats_are_persisted_and_reloaded(stats):
+    record(stats, "graphviz", 0.7, valid=2, invalid=1)
+    reloaded = ValidityStats(stats.path)
+    assert reloaded.entries == stats.entries
+    assert reloaded.aggregate("graphviz", 0.7) == {"attempts": 3, "valid": 2, "latency": 3.0, "completion_tokens": 300}
+
+def test_aggregate_filters_by_category_and_temperature(stats):
+    record(stats, "graphviz", 0.7, valid=1, invalid=0)
+    record(stats, "mermaid", 1.3, valid=0, invalid=2)
+    assert stats.aggregate(None, None)["attempts"] == 3
+    assert stats.aggregate("mermaid", None)["valid"] == 0
+    assert stats.aggregate(None, 0.7)["attempts"] == 1
+    assert stats.aggregate("graphviz", 1.3)["attempts"] == 0
+
+def test_defaults_are_kept_until_enough_attempts(stats):
+    policy = SamplingPolicy(stats, min_attempts=20)
+    assert policy.choose("graphviz", 1000) is None
+    record(stats, "graphviz", 0.7, valid=0, invalid=1)
+    assert policy.choose("graphviz", 1000) is None
+    record(stats, "graphviz", 0.7, valid=10, invalid=9)
+    assert policy.choose("graphviz", 1000) is not None
+
+def test_candidates_needed_reaches_the_target(stats):
+    policy = SamplingPolicy(stats, target=0.9, max_n=5)
+    assert policy.candidates_needed(0.95, 5) == 1
+    assert policy.candidates_needed(0.5, 5) == 4 # 1 - 0.5 ** 4 >= 0.9
+    assert policy.candidates_needed(0.1, 5) == 5
+    assert policy.candidates_needed(0.0, 3) == 3
+
+def test_reliable_temperatures_need_one_candidate(stats):
+    record(stats, "graphviz", 0.7, valid=40, invalid=0)
+    policy = SamplingPolicy(stats, temperatures=[0.7], min_attempts=20)
+    assert policy.choose("graphviz", 1000) == (1, 0.7)
+
+def test_unreliable_prompts_sample_more_candidates_unless_limited(stats):
+    record(stats, "graphviz", 0.7, valid=10, invalid=30)
+    policy = SamplingPolicy(stats, temperatures=[0.7], max_n=5, min_attempts=20)
+    n, temperature = policy.choose("graphviz", 1000)
+    assert n > 1
+    assert policy.choose("graphviz", 1000, max_n=1) == (1, 0.7)
+
+def test_the_more_valid_temperature_is_chosen(stats):
+    record(stats, "graphviz", 0.7, valid=5, invalid=35)
+    record(stats, "graphviz", 1.3, valid=38, invalid=2)
+    policy = SamplingPolicy(stats, temperatures=[0.7, 1.3], min_attempts=20)
+    assert policy.choose("graphviz", 1000)[1] == 1.3
@@ -0,0 +1,95 @@
+"""here live tests of the admission and retry logic of the openai request scheduler"""
+
+import pytest
+
+import scheduler
+from scheduler import RequestScheduler, RetryableError
+
+def test_first_request_is_always_admissible():
+    s = RequestScheduler(requests_per_minute=1, tokens_per_minute=10)
+    assert s.time_until_admissible(1000, now=0) == 0
+
+def test_token_budget_delays_until_oldest_admission_expires():
+    s = RequestScheduler(requests_per_minute=100, tokens_per_minute=100)
+    s.window.extend([(0, 60), (10, 30)])
+    assert s.time_until_admissible(10, now=20) == 0
+    # 60 + 30 + 20 tokens exceed the budget until the admission at 0 expires
+    assert s.time_until_admissible(20, now=20) == pytest.approx(40)
+    # even after both expire, nothing else is waiting
+    assert s.time_until_admissible(90, now=20) == pytest.approx(50)
+
+def test_request_budget_delays_until_enough_admissions_expire():
+    s = RequestScheduler(requests_per_minute=2, tokens_per_minute=1000)
+    s.window.extend([(0, 1), (5, 1)])
+    assert s.time_until_admissible(1, now=10) == pytest.approx(50)
+
+def test_window_expires_after_a_minute():
+    s = RequestScheduler(requests_per_minute=1, tokens_per_minute=10)
+    s.window.append((0, 10))
+    assert s.time_until_admissible(10, now=30) > 0
+    assert s.time_until_admissible(10, now=60) == 0
+    assert not s.window
+
+def test_try_acquire_admits_only_within_budget():
+    s = RequestScheduler(requests_per_minute=2, tokens_per_minute=100)
+    assert s.try_acquire(60)
+    assert not s.try_acquire(60)
+    assert s.try_acquire(40)
+    assert not s.try_acquire(1)
+
+def test_try_acquire_does_not_overtake_waiting_requests():
+    s = RequestScheduler(requests_per_minute=10, tokens_per_minute=100)
+    s.waiting.append((0, 0))
+    assert not s.try_acquire(1)
+
+def test_acquire_records_admission():
+    s = RequestScheduler(requests_per_minute=10, tokens_per_minute=100)
+    s.acquire(30)
+    assert [tokens for _, tokens in s.window] == [30]
+    assert not s.waiting
+
+def test_backoff_honours_retry_after():
+    s = RequestScheduler(backoff_base=1, backoff_max=4)
+    assert s.backoff(10, retry_after=None) <= 4
+    assert s.backoff(0, retry_after=7) == 7
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(scheduler.time, "sleep", sleeps.append)
+    return sleeps
+
+def test_run_retries_retryable_errors(no_sleep):
+    s = RequestScheduler(requests_per_minute=100, tokens_per_minute=1000, max_retries=2)
+    attempts = []
+
+    def request():
+        attempts.append(None)
+        if len(attempts) < 3:
+            raise RetryableError("429", retry_after=1)
+        return "ok"
+
+    assert s.run(request, tokens=1) == "ok"
+    assert len(attempts) == 3
+    assert len(no_sleep) == 2 and all(delay >= 1 for delay in no_sleep)
+    assert len(s.window) == 3 # every attempt is charged
+
+def test_run_gives_up_after_max_retries(no_sleep):
+    s = RequestScheduler(requests_per_minute=100, tokens_per_minute=1000, max_retries=1)
+
+    def request():
+        raise RetryableError("503")
+
+    with pytest.raises(RetryableError):
+        s.run(request, tokens=1)
+    assert len(no_sleep) == 1
+
+def test_run_does_not_retry_other_errors(no_sleep):
+    s = RequestScheduler(requests_per_minute=100, tokens_per_minute=1000, max_retries=3)
+
+    def request():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        s.run(request, tokens=1)
+    assert not no_sleep
@@ -0,0 +1,67 @@
+"""here live tests of saving and resuming REPL sessions"""
+
+import gzip
+
+import pytest
+
+from chatGPT_official import InteractionMode, Model
+import primer_bundle
+from session import SessionStore
+
+@pytest.fixture
+def bundle(tmp_path, monkeypatch):
+    monkeypatch.setattr(primer_bundle.tokens, "count_message_tokens", lambda message, model: len(message["content"]))
+    problems = tmp_path / "problems.txt"
+    problems.write_text("---PROBLEM\nA is B.\nCODE_BLOCK_START\nblockdiag {\n  A -> B;\n}\nCODE_BLOCK_STOP\nDIAGRAM_API=blockdiag\n")
+    return primer_bundle.compile_bundle(problems)
+
+def primed_model(bundle):
+    model = Model()
+    model.load_bundle(bundle)
+    model.backup_messages()
+    return model
+
+@pytest.fixture
+def store(tmp_path):
+    return SessionStore(tmp_path / "sessions")
+
+def test_session_round_trip(bundle, store):
+    model = primed_model(bundle)
+    model.set_interaction_mode(InteractionMode.STATEFUL)
+    model.messages.append({"role": "user", "content": "A is B."})
+    model.messages.append({"role": "assistant", "content": "CODE_BLOCK_START\nblockdiag {}\nCODE_BLOCK_STOP"})
+    store.save("s1", model)
+    assert store.list_sessions() == ["s1"]
+
+    resumed = primed_model(bundle)
+    store.restore("s1", resumed)
+    assert resumed.interaction_mode == InteractionMode.STATEFUL
+    assert resumed.messages == model.messages
+    assert resumed.messages_backup == model.messages_backup
+
+def test_session_stores_only_the_messages_after_the_primer(bundle, store):
+    model = primed_model(bundle)
+    model.messages.append({"role": "user", "content": "A is B."})
+    store.save("s1", model)
+    with gzip.open(store.path("s1"), "rt") as f:
+        assert "tail" in f.read() and len(store.path("s1").read_bytes()) < 1000
+
+def test_session_of_another_bundle_is_rejected(bundle, store):
+    store.save("s1", primed_model(bundle))
+    other = dict(bundle, source_hash="other")
+    model = primed_model(other)
+    messages = list(model.messages)
+    with pytest.raises(ValueError, match="different primer bundle"):
+        store.restore("s1", model)
+    assert model.messages == messages # unchanged
+
+def test_corrupt_session_is_rejected(bundle, store):
+    store.path("s1").parent.mkdir(parents=True)
+    store.path("s1").write_bytes(b"not gzip")
+    with pytest.raises(ValueError, match="corrupt"):
+        store.restore("s1", primed_model(bundle))
+
+def test_session_ids_are_file_names(store):
+    for session_id in ["", "../escape", "a/b"]:
+        with pytest.raises(ValueError):
+            store.path(session_id)
@@ -0,0 +1,54 @@
+"""here live tests of single-flight coalescing"""
+
+import threading
+
+import pytest
+
+from singleflight import SingleFlight
+
+def test_concurrent_calls_are_coalesced():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(None)
+        started.set()
+        release.wait()
+        return "result"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.do("key", fn)))
+    leader.start()
+    started.wait()
+    flight = flights.flights["key"]
+    waiting = threading.Semaphore(0)
+    wait = flight.done.wait
+
+    def count_waiting():
+        waiting.release()
+        return wait()
+
+    flight.done.wait = count_waiting
+    followers = [threading.Thread(target=lambda: results.append(flights.do("key", fn))) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    for _ in followers: # release the leader only once every follower waits for its flight
+        waiting.acquire()
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join()
+    assert results == ["result"] * 4
+    assert len(calls) == 1
+
+def test_errors_are_shared_and_not_kept():
+    flights = SingleFlight()
+
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        flights.do("key", fail)
+    assert flights.do("key", lambda: 1) == 1
+    assert not flights.flights
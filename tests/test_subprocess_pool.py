@@ -0,0 +1,41 @@
+"""here live tests of the pool of warm subprocesses that local renderers run on"""
+
+import pickle
+import shutil
+import time
+
+import pytest
+
+import chatGPT_official
+from subprocess_pool import SubprocessPool
+
+pytestmark = pytest.mark.skipif(shutil.which("cat") is None, reason="needs cat")
+
+@pytest.fixture
+def pool():
+    pool = SubprocessPool(["cat"], size=2)
+    pool.warm_up()
+    yield pool
+    pool.close()
+
+def test_run_uses_and_replaces_idle_processes(pool):
+    assert pool.run(b"a -> b", timeout=5) == (0, b"a -> b", b"")
+    assert pool.run(b"b -> c", timeout=5) == (0, b"b -> c", b"")
+
+def test_openai_child_does_not_hold_idle_processes_open(pool):
+    # a forked child would inherit the stdin of the idle processes, which then wait for EOF until the child exits
+    child = chatGPT_official.mp_context.Process(target=time.sleep, args=(3,))
+    child.start()
+    try:
+        start_time = time.time()
+        assert pool.run(b"a -> b", timeout=5)[1] == b"a -> b"
+        assert time.time() - start_time < 1
+    finally:
+        child.terminate()
+        child.join()
+
+def test_model_is_sent_to_the_child_without_unpicklable_state():
+    model = chatGPT_official.Model(scheduler=chatGPT_official.RequestScheduler())
+    state = model.__getstate__()
+    assert state["scheduler"] is None
+    assert pickle.loads(pickle.dumps(model)).model == model.model